@@ -1,73 +1,100 @@
-// Calculate depth based on proximity
+// Calculate depth based on proximity, using jump flooding
 
 #define WATER 11
+#define NOSEED -1
+
+__kernel void bathyinit(__global int *seeds, __global const int *lcdata, const uint xlen, const uint ylen) {
+  // seeds -- OUTPUT: index of nearest non-water point, or NOSEED
+  // lcdata -- INPUT: landcover values
+  // xlen, ylen -- INPUT: dimensions of data
 
-__kernel void bathy(__global int *outdata, __global int *indata, const uint xlen, const uint ylen, const uint currdepth, const uint maxdepth) {
-  // outdata -- OUTPUT: the next array
-  // indata -- INPUT: the current array
-  // xlen, ylen -- INPUT: dimensions of data 
-  // currdepth -- INPUT: which depth is now being set
-  // maxdepth -- INPUT: the maximum depth
-  
   uint gid = get_global_id(0);
   uint gsize = get_global_size(0);
 
   uint nelems = xlen * ylen;
 
-  // iterate through all the data values
+  // every non-water point is its own nearest non-water point
   for (uint idx = gid; idx < nelems; idx += gsize) {
-    int inval, outval;
+    if (lcdata[idx] == WATER) {
+      seeds[idx] = NOSEED;
+    } else {
+      seeds[idx] = idx;
+    }
+  } // end for uint idx
+} // end kernel
 
-    inval = indata[idx];
+__kernel void bathyjump(__global int *outseeds, __global const int *inseeds, const uint xlen, const uint ylen, const int step) {
+  // outseeds -- OUTPUT: the next array of nearest seeds
+  // inseeds -- INPUT: the current array of nearest seeds
+  // xlen, ylen -- INPUT: dimensions of data
+  // step -- INPUT: distance to neighbors checked on this pass
 
-    // default value for output is input
-    outval = indata[idx];
+  uint gid = get_global_id(0);
+  uint gsize = get_global_size(0);
 
-    if (currdepth <= maxdepth) {
-      if (currdepth == 0) {
-	if (indata[idx] == WATER) {
-	  outval = -1;
-	} else {
-	  outval = 0;
-	}
-      } else if (currdepth == maxdepth) {
-	if (indata[idx] == -1) {
-	  outval = maxdepth;
-	}
-      } else {
-	if (indata[idx] == -1) {
-	  uint xval = idx / ylen;
-	  uint yval = idx % ylen;
-	  int minval = maxdepth;
-	  int inval;
-
-	  if (xval != 0) {
-	    inval = indata[idx-ylen];
-	    if (inval != -1 && inval < minval)
-	      minval = inval;
-	  }
-	  if (xval != xlen) {
-	    inval = indata[idx+ylen];
-	    if (inval != -1 && inval < minval)
-	      minval = inval;
-	  }
-	  if (yval != 0) {
-	    inval = indata[idx-1];
-	    if (inval != -1 && inval < minval)
-	      minval = inval;
-	  }
-	  if (yval != ylen) {
-	    inval = indata[idx+1];
-	    if (inval != -1 && inval < minval)
-	      minval = inval;
-	  }
-	  if (minval < maxdepth) {
-	    outval = minval+1;
+  uint nelems = xlen * ylen;
+
+  // iterate through all the data values
+  for (uint idx = gid; idx < nelems; idx += gsize) {
+    int xval = idx / ylen;
+    int yval = idx % ylen;
+    int bestseed = inseeds[idx];
+    int bestdist = INT_MAX;
+
+    if (bestseed != NOSEED) {
+      int dx = bestseed / ylen - xval;
+      int dy = bestseed % ylen - yval;
+      bestdist = dx*dx + dy*dy;
+    }
+
+    // check the eight neighbors step points away
+    for (int nx = xval-step; nx <= xval+step; nx += step) {
+      if (nx < 0 || nx >= (int)xlen)
+	continue;
+      for (int ny = yval-step; ny <= yval+step; ny += step) {
+	if (ny < 0 || ny >= (int)ylen)
+	  continue;
+	int seed = inseeds[nx*ylen+ny];
+	if (seed != NOSEED) {
+	  int dx = seed / ylen - xval;
+	  int dy = seed % ylen - yval;
+	  int dist = dx*dx + dy*dy;
+	  if (dist < bestdist) {
+	    bestdist = dist;
+	    bestseed = seed;
 	  }
 	}
       }
-      // write output
-      outdata[idx] = outval;
-    } // end if currdepth <= maxdepth
+    }
+    // write output
+    outseeds[idx] = bestseed;
+  } // end for uint idx
+} // end kernel
+
+__kernel void bathydepth(__global int *outdata, __global const int *seeds, const uint xlen, const uint ylen, const uint maxdepth) {
+  // outdata -- OUTPUT: depth values
+  // seeds -- INPUT: index of nearest non-water point, or NOSEED
+  // xlen, ylen -- INPUT: dimensions of data
+  // maxdepth -- INPUT: the maximum depth
+
+  uint gid = get_global_id(0);
+  uint gsize = get_global_size(0);
+
+  uint nelems = xlen * ylen;
+
+  // depth is the rounded distance to the nearest seed, capped at maxdepth
+  for (uint idx = gid; idx < nelems; idx += gsize) {
+    int outval = maxdepth;
+    int seed = seeds[idx];
+
+    if (seed != NOSEED) {
+      int dx = seed / ylen - (int)(idx / ylen);
+      int dy = seed % ylen - (int)(idx % ylen);
+      int depth = (int)(sqrt((float)(dx*dx + dy*dy)) + 0.5f);
+      if (depth < outval)
+	outval = depth;
+    }
+    // write output
+    outdata[idx] = outval;
   } // end for uint idx
 } // end kernel
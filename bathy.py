@@ -1,12 +1,8 @@
 # Bathymetric data -- OpenCL and GDAL both
 from osgeo import gdal
-from utils import chunks
-from itertools import product
-from time import time
 import numpy as np
 #
-import gzip
-import cPickle as pickle
+import capture
 
 try:
     import pyopencl as cl
@@ -14,10 +10,14 @@ try:
     hasCL = True
 except ImportError:
     hasCL = False
+from clmanager import CLManager
 
 
 class Bathy(object):
 
+    # replayed backends may differ by this much
+    allowed_error_percentage = 3
+
     def __init__(self, lcarray, geotrans, projection, wantCL=True,
                  platform_num=None):
         """
@@ -36,45 +36,25 @@ class Bathy(object):
 
         self.wantCL = wantCL
         self.canCL = False
+        # set by each call to the backend it actually ran
+        self.usedCL = False
 
         if hasCL and self.wantCL:
-            try:
-                platforms = cl.get_platforms()
-                try:
-                    platform = platforms[platform_num]
-                    self.devices = self.platform.get_devices()
-                    self.context = cl.Context(self.devices)
-                except TypeError:
-                    # The user may be asked to select a platform.
-                    self.context = cl.create_some_context()
-                    self.devices = self.context.devices
-                except IndexError:
-                    raise
-                self.queue = cl.CommandQueue(self.context)
-                filestr = ''.join(open('bathy.cl', 'r').readlines())
-                self.program = cl.Program(self.context, filestr).build(devices=self.devices)
-                for device in self.devices:
-                    buildlog = self.program.get_build_info(device, cl.program_build_info.LOG)
-                    if (len(buildlog) > 1):
-                        print 'Build log for device', device, ':\n', buildlog
-                # Only the first kernel is used.
-                self.kernel = self.program.all_kernels()[0]
-
-                # Local and global sizes are device-dependent.
-                self.local_size = {}
-                self.global_size = {}
-                # Groups should be overcommitted.
-                # For now, use 3 (48 cores / 16 cores per halfwarp) * 2
-                for device in self.devices:
-                    work_group_size = self.kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
-                    num_groups_for_1d = device.max_compute_units * 3 * 2
-                    self.local_size[device] = (work_group_size,)
-                    self.global_size[device] = (num_groups_for_1d * work_group_size, )
-                self.canCL = True
-            except cl.RuntimeError:
+            manager = CLManager.get(platform_num)
+            program = None if manager is None else manager.program('bathy')
+            if program is None:
                 print 'warning: unable to use pyopencl, defaulting to GDAL'
+            else:
+                self.devices = manager.devices
+                self.context = manager.context
+                self.queue = manager.queue
+                self.program = program
+                # Local and global sizes are device- and kernel-dependent.
+                self.kernels = dict([(name, getattr(self.program, name)) for name in ['bathyinit', 'bathyjump', 'bathydepth']])
+                self.worksizes = dict([(name, manager.worksizes(self.kernels[name])) for name in self.kernels])
+                self.canCL = True
 
-    def __call__(self, maxdepth, pickle_name=None):
+    def __call__(self, maxdepth, capture_name=None):
         """
         Traverse the landcover array.  For every point of type
         'water', calculate the distance to the nearest non-water
@@ -85,68 +65,49 @@ class Bathy(object):
 
         """
 
-        if self.canCL and self.wantCL:
-            # Create working array
+        useCL = self.canCL and self.wantCL
+        if useCL:
+            # The whole array stays on the device: one landcover buffer
+            # reused for results and two seed buffers, all 32bit.
+            nbytes = self.lcarray.size * 4
+            fits = [(nbytes < 0.95*device.max_mem_alloc_size and 3*nbytes < 0.95*device.global_mem_size) for device in self.devices]
+            if True not in fits:
+                print 'warning: landcover array too large for OpenCL device, defaulting to GDAL'
+                useCL = False
+        self.usedCL = useCL
+        if useCL:
             xlen, ylen = self.lcarray.shape
             workingarr = np.array(self.lcarray.ravel(), dtype=np.int32)
             # These values do not change from run to run.
+            xlen_arg = np.uint32(xlen)
             ylen_arg = np.uint32(ylen)
             maxdepth_arg = np.uint32(maxdepth)
-            # Calculate how many base elements can be evaluated per run.
-            # Each run requires xlen, ylen, currdepth, and maxdepth -- all 32bit.
-            static_data = 4 * 4
-            # Each base element requires two 32bit integers.
-            bytes_per_elem_single = 2*4
-            bytes_per_elem_total = bytes_per_elem_single
-            # Use rows instead of elems for two-dimensional arrays.
-            bytes_per_row_single = bytes_per_elem_single * ylen
-            bytes_per_row_total = bytes_per_elem_total * ylen
-            # Check both single and total limits on rows-per-slice.
-            rps_single = [int(0.95*device.max_mem_alloc_size/bytes_per_row_single) for device in self.devices]
-            rps_total = [int((0.95*device.global_mem_size-static_data)/bytes_per_row_total) for device in self.devices]
-            row_limits = [min(rps_single[x], rps_total[x]) for x in xrange(len(self.devices))]
             # NB: Only supporting one device for now.
-            best_device = np.argmax(row_limits)
-            best_rows = row_limits[best_device]
-            global_size = self.global_size[self.devices[best_device]]
-            local_size = self.local_size[self.devices[best_device]]
-            # For now, at least, do not create retval or chunk buffer here.
-            # Iterate through this entire mess once per depth level
-            row_list = np.array([x for x in xrange(xlen)])
-            negfound = False
-            for row_chunk in chunks(row_list, best_rows):
-                # Do not prepend buffer rows for first row.
-                realfirst = row_chunk[0]
-                if (row_chunk[0] != row_list[0]):
-                    realfirst -= maxdepth
-                # Do not postpend buffer rows for last row.
-                reallast = row_chunk[-1]
-                if (row_chunk[-1] != row_list[-1]):
-                    reallast += maxdepth
-                # Create retvals and chunk buffer here instead of above.
-                chunk = np.copy(workingarr[realfirst*ylen:reallast*ylen])
-                outchunk_buf = cla.empty(self.queue, chunk.shape, chunk.dtype)
-                inchunk_buf = cla.to_device(self.queue, chunk)
-                newxlen = reallast-realfirst
-                newxlen_arg = np.uint32(newxlen)
-                lenchunk = newxlen*ylen
-                lenchunk_arg = np.uint32(lenchunk)
-                currdepth = 0
-                while (currdepth <= maxdepth):
-                    currdepth_arg = np.uint32(currdepth)
-                    if (currdepth % 2 == 0):
-                        event = self.program.bathy(self.queue, global_size, local_size, outchunk_buf.data, inchunk_buf.data, newxlen_arg, ylen_arg, currdepth_arg, maxdepth_arg)
-                    else:
-                        event = self.program.bathy(self.queue, global_size, local_size, inchunk_buf.data, outchunk_buf.data, newxlen_arg, ylen_arg, currdepth_arg, maxdepth_arg)
-                    event.wait()
-                    currdepth += 1
-                # Copy relevant part of outchunk_buf to workingarr.
-                chunk_arr = outchunk_buf.get()
-                copytop = 0
-                if (row_chunk[0] != row_list[0]):
-                    copytop += maxdepth
-                copybot = len(row_chunk)-1
-                workingarr[row_chunk[0]*ylen:row_chunk[-1]*ylen] = chunk_arr[copytop*ylen:copybot*ylen]
+            best_device = fits.index(True)
+            device = self.devices[best_device]
+            # each kernel gets the work group size it supports
+            (initlocal, initglobal) = [size[device] for size in self.worksizes['bathyinit']]
+            (jumplocal, jumpglobal) = [size[device] for size in self.worksizes['bathyjump']]
+            (depthlocal, depthglobal) = [size[device] for size in self.worksizes['bathydepth']]
+            data_buf = cla.to_device(self.queue, workingarr)
+            seeds_bufs = [cla.empty(self.queue, workingarr.shape, np.int32) for x in xrange(2)]
+            self.kernels['bathyinit'](self.queue, initglobal, initlocal, seeds_bufs[0].data, data_buf.data, xlen_arg, ylen_arg)
+            # Jump flooding: halve the step from the smallest power of
+            # two covering maxdepth, then one more pass at step one.
+            step = 1
+            while step < maxdepth:
+                step *= 2
+            steps = []
+            while step > 0:
+                steps.append(step)
+                step //= 2
+            steps.append(1)
+            for step in steps:
+                self.kernels['bathyjump'](self.queue, jumpglobal, jumplocal, seeds_bufs[1].data, seeds_bufs[0].data, xlen_arg, ylen_arg, np.int32(step))
+                seeds_bufs.reverse()
+            event = self.kernels['bathydepth'](self.queue, depthglobal, depthlocal, data_buf.data, seeds_bufs[0].data, xlen_arg, ylen_arg, maxdepth_arg)
+            event.wait()
+            workingarr = data_buf.get()
             results = workingarr.reshape((self.lcarray.shape))[maxdepth:-1*maxdepth, maxdepth:-1*maxdepth]
         else:
             (depthz, depthx) = self.lcarray.shape
@@ -168,97 +129,24 @@ class Bathy(object):
             # extract array
             results = bathyband.ReadAsArray(maxdepth, maxdepth, bathyds.RasterXSize-2*maxdepth, bathyds.RasterYSize-2*maxdepth)
 
-        if pickle_name is not None:
-            # Pickle variables for testing purposes.
-            picklefilename = 'bathy-%s.pkl.gz' % pickle_name
-            print 'Pickling to %s...' % picklefilename
-            f = gzip.open(picklefilename, 'wb')
-            pickle.dump(self.lcarray, f, -1)
-            pickle.dump(self.geotrans, f, -1)
-            pickle.dump(self.projection, f, -1)
-            pickle.dump(maxdepth, f, -1)
-            # pickle.dump(results, f, -1)
+        if capture_name is not None:
+            # Capture inputs for replay.
+            capture.save('bathy-%s' % capture_name, 'bathy', {'lcarray': self.lcarray}, {'geotrans': list(self.geotrans), 'projection': self.projection, 'maxdepth': maxdepth})
         return results
 
     @staticmethod
-    def test(fileobj, image=False):
-        # Import from pickled variables for now.
-        jar = gzip.GzipFile(fileobj=fileobj)
-        lcarray = pickle.load(jar)
-        geotrans = pickle.load(jar)
-        projection = pickle.load(jar)
-        maxdepth = pickle.load(jar)
-        jar.close()
-        lenbase = (lcarray.shape[0]-maxdepth*2)*(lcarray.shape[1]-maxdepth*2)
-
-        print 'Generating results with OpenCL'
-        atime1 = time()
-        gpu_bathy = Bathy(lcarray, geotrans, projection, wantCL=True)
-        if not gpu_bathy.canCL:
+    def replay(arrays, params, wantCL=True):
+        """Runs captured inputs on one backend."""
+        bathy = Bathy(arrays['lcarray'], params['geotrans'], str(params['projection']), wantCL=wantCL)
+        if wantCL and not bathy.canCL:
             raise AssertionError('Cannot run test without working OpenCL')
-        gpu_results = gpu_bathy(maxdepth)
-        atime2 = time()
-        adelta = atime2-atime1
-        print '... finished in ', adelta, 'seconds!'
-
-        print 'Generating results with GDAL'
-        btime1 = time()
-        cpu_bathy = Bathy(lcarray, geotrans, projection, wantCL=False)
-        cpu_results = cpu_bathy(maxdepth)
-        btime2 = time()
-        bdelta = btime2-btime1
-        print '... finished in ', bdelta, 'seconds!'
-
-        # Compare the results.
-        allowed_error_percentage = 3
-        maxnomatch = int(allowed_error_percentage*0.01*lenbase)
-        xlen, ylen = gpu_results.shape
-        if image:
-            print 'Generating image of differences'
-            import re
-            import Image
-            imagefile = re.sub('pkl.gz', 'png', fileobj.name)
-            # diffarr = (cpu_results + 128 - gpu_results)
-            diffarr = np.array([[int(128 + cpu_results[x, y] - gpu_results[x, y]) for y in xrange(ylen)] for x in xrange(xlen)], dtype=np.int32)
-            Image.fromarray(diffarr).save(imagefile)
-        else:
-            nomatch = sum([1 if abs(cpu_results[x, y] - gpu_results[x, y]) > 0.0001 else 0 for x, y in product(xrange(xlen), xrange(ylen))])
-            nomatchmsg = '%d of %d (%d%%) failed to match' % (nomatch, lenbase, 100*nomatch/lenbase)
-            if nomatch > maxnomatch:
-                countprint = 0
-                for x, y in product(xrange(xlen), xrange(ylen)):
-                    if abs(cpu_results[x, y] - gpu_results[x, y]) > 0.0001:
-                        countprint += 1
-                        if countprint < 10:
-                            print "no match at ", x, y
-                            print " CPU: ", cpu_results[x, y]
-                            print " GPU: ", gpu_results[x, y]
-                        else:
-                            break
-                raise AssertionError(nomatchmsg)
-            else:
-                print nomatchmsg
+        return bathy(params['maxdepth'])
 
 
 def main():
     """Test routine to confirm module consistency."""
-
-    import argparse
-    import glob
-
-    parser = argparse.ArgumentParser(description='Test bathy functionality with OpenCL and GDAL.')
-    parser.add_argument('files', type=argparse.FileType('r'), nargs='*',
-                        help='a data file to be processed')
-    parser.add_argument('--image', action='store_true',
-                        help='generate an image with the differences')
-
-    args = parser.parse_args()
-    if (args.files == []):
-        args.files = [open(file) for file in glob.glob('./bathy-*.pkl.gz')]
-    for testfile in args.files:
-        print 'Testing %s' % testfile.name
-        Bathy.test(testfile, image=args.image)
-        testfile.close()
+    from replay import main as replaymain
+    return replaymain('bathy')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+import logging
+logging.basicConfig(level=logging.WARNING)
+import sys
+import os
+import json
+import socket
+import argparse
+import subprocess
+from time import time
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from osgeo import gdal, osr
+from osgeo.gdalconst import GDT_Byte, GDT_Float32
+from region import Region
+
+# benchmark results are appended here, one JSON object per line
+historyfile = os.path.join('benchmarks', 'history.jsonl')
+
+# NLCD 2006 classes and their default share of the landcover
+defaultmix = {11: 0.20, 21: 0.05, 22: 0.05, 23: 0.03, 24: 0.02, 31: 0.05, 41: 0.15, 42: 0.10,
+              43: 0.05, 52: 0.05, 71: 0.05, 81: 0.05, 82: 0.05, 90: 0.05, 95: 0.05}
+
+
+def checkMix(string):
+    """Parses a land-class mix such as '11=0.3,41=0.7'."""
+    try:
+        mix = dict([(int(key), float(value)) for (key, value) in [pair.split('=') for pair in string.split(',')]])
+    except ValueError:
+        raise argparse.ArgumentTypeError, 'land-class mix invalid: %s' % string
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError, 'land-class mix invalid: %s' % string
+    return mix
+
+
+def smoothfield(shape, sigma, randomstate):
+    """Returns smoothed noise scaled to the range 0-1."""
+    field = gaussian_filter(randomstate.uniform(size=shape), sigma)
+    field -= field.min()
+    fieldmax = field.max()
+    if fieldmax > 0:
+        field /= fieldmax
+    return field
+
+
+def synthesize(region, resolution, mix, elmax, seed):
+    """Writes synthetic elevation and landcover datasets covering the region."""
+    randomstate = np.random.RandomState(seed)
+    # landcover extents include the bathy border, so one grid covers both
+    extents = region.albersextents['landcover']
+    margin = 4 * resolution
+    xmin = extents['xmin'] - margin
+    ymax = extents['ymax'] + margin
+    xsize = int((extents['xmax'] + margin - xmin) / resolution)
+    ysize = int((ymax - (extents['ymin'] - margin)) / resolution)
+    shape = (ysize, xsize)
+    sigma = max(xsize, ysize) / 16.0
+
+    # lowest ground is water, the rest is split between classes by a second field
+    elarray = smoothfield(shape, sigma, randomstate) * elmax
+    lcarray = np.zeros(shape, dtype=np.uint8)
+    total = float(sum(mix.values()))
+    water = mix.get(11, 0) / total
+    sealine = np.percentile(elarray, 100 * water) if water > 0 else -1
+    iswater = elarray <= sealine
+    lcarray[iswater] = 11
+    elarray[iswater] = 0
+    classfield = smoothfield(shape, sigma / 4, randomstate)[~iswater]
+    classes = sorted([key for key in mix if key != 11])
+    landtotal = sum([mix[key] for key in classes])
+    landvalues = np.zeros(classfield.shape, dtype=np.uint8)
+    if classes and classfield.size:
+        bounds = np.percentile(classfield, list(100 * np.cumsum([mix[key] for key in classes]) / landtotal))
+        landvalues = np.array(classes, dtype=np.uint8)[np.minimum(np.searchsorted(bounds, classfield), len(classes) - 1)]
+    lcarray[~iswater] = landvalues
+
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4(Region.albers)
+    geotrans = [xmin, resolution, 0, ymax, 0, -1 * resolution]
+    driver = gdal.GetDriverByName('GTiff')
+    for (layer, array, datatype) in [(region.ellayer, elarray, GDT_Float32), (region.lclayer, lcarray, GDT_Byte)]:
+        tiffile = os.path.join(region.mapsdir, '%s.tif' % layer)
+        ds = driver.Create(tiffile, xsize, ysize, 1, datatype)
+        ds.SetGeoTransform(geotrans)
+        ds.SetProjection(srs.ExportToWkt())
+        ds.GetRasterBand(1).WriteArray(array)
+        ds = None
+    return shape
+
+
+def makeregion(name, tiles, tilesize, scale, lat, lon):
+    """Creates an offline region of about tiles x tiles tiles around a point."""
+    realsize = tilesize * scale
+    [cx, dummy, cy, dummy] = Region.get_corners(Region.wgs84, Region.albers, lon, lon, lat, lat)
+    # align to the tile grid and stay inside it through reprojection
+    left = (int(cx // realsize) - tiles // 2) * realsize
+    bottom = (int(cy // realsize) - tiles // 2) * realsize
+    inset = realsize // 8
+    [xmax, xmin, ymax, ymin] = Region.get_corners(Region.albers, Region.wgs84, left + tiles * realsize - inset, left + inset, bottom + tiles * realsize - inset, bottom + inset)
+    return Region(name=name, xmax=xmax, xmin=xmin, ymax=ymax, ymin=ymin, tilesize=tilesize, scale=scale, lcIDs=['L6N'], offline=True)
+
+
+def runstage(script, args, reportfile):
+    """Runs one pipeline script and returns its run report."""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script)] + args
+    print 'Running %s...' % ' '.join(command)
+    starttime = time()
+    subprocess.check_call(command)
+    elapsed = time() - starttime
+    stream = file(reportfile, 'r')
+    report = json.load(stream)
+    stream.close()
+    return {'wall': elapsed,
+            'phases': report['wall'],
+            'cpu': report['cpu'],
+            'peakrss': report['peakrss'],
+            'childpeakrss': report['children']['peakrss']}
+
+
+def loadhistory():
+    """Returns every recorded benchmark run."""
+    if not os.path.exists(historyfile):
+        return []
+    stream = file(historyfile, 'r')
+    history = [json.loads(line) for line in stream if line.strip()]
+    stream.close()
+    return history
+
+
+def revision():
+    """Returns the current git revision, if any."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    """Prints each stage and phase time against the baseline."""
+    print 'Compared with %s (%s):' % (baseline['label'], baseline['revision'])
+    for stage in sorted(current['stages']):
+        if stage not in baseline['stages']:
+            continue
+        old = baseline['stages'][stage]
+        new = current['stages'][stage]
+        rows = [(stage, old['wall'], new['wall'])]
+        rows += [('  %s' % phase, old['phases'].get(phase, 0), new['phases'][phase]) for phase in sorted(new['phases'])]
+        rows += [('  peakrss', old['peakrss'], new['peakrss'])]
+        for (label, before, after) in rows:
+            ratio = after / float(before) if before else float('nan')
+            print '%-20s %12.2f %12.2f %8.2fx' % (label, before, after, ratio)
+
+
+def main():
+    """Benchmarks region preparation and building on a synthetic region."""
+    parser = argparse.ArgumentParser(description='Benchmarks prepregion and buildregion offline on synthetic data.')
+    parser.add_argument('--name', default='Benchmark', type=str, help='name of the synthetic region (default Benchmark)')
+    parser.add_argument('--label', type=str, help='label for this run in the history (default git revision)')
+    parser.add_argument('--baseline', type=str, help='label of the run to compare against (default latest matching run)')
+    parser.add_argument('--tiles', default=2, type=int, help='region width and height in tiles (default 2)')
+    parser.add_argument('--tilesize', default=Region.tilesize, type=int, help='tilesize value (default %d)' % Region.tilesize)
+    parser.add_argument('--scale', default=Region.scale, type=int, help='scale value (default %d)' % Region.scale)
+    parser.add_argument('--resolution', default=30, type=int, help='resolution of synthetic datasets in meters (default 30)')
+    parser.add_argument('--elmax', default=300, type=int, help='highest synthetic elevation in meters (default 300)')
+    parser.add_argument('--mix', default=defaultmix, type=checkMix, help='land-class mix such as 11=0.3,41=0.7 (default NLCD-like mix)')
+    parser.add_argument('--seed', default=0, type=int, help='random seed for synthetic data (default 0)')
+    parser.add_argument('--lat', default=41.19, type=float, help='latitude of region center (default 41.19)')
+    parser.add_argument('--lon', default=-71.58, type=float, help='longitude of region center (default -71.58)')
+    parser.add_argument('--disable-opencl', action='store_true', dest='noOCL', help='disable OpenCL code')
+    parser.add_argument('--single', action='store_true', help='build tiles in a single process')
+    parser.add_argument('--no-history', action='store_false', dest='doHistory', default=True, help='do not record this run')
+    args = parser.parse_args()
+
+    params = {'tiles': args.tiles, 'tilesize': args.tilesize, 'scale': args.scale, 'resolution': args.resolution,
+              'elmax': args.elmax, 'mix': dict([(str(key), value) for (key, value) in args.mix.items()]), 'seed': args.seed,
+              'opencl': not args.noOCL, 'single': args.single}
+
+    print "Creating synthetic region %s..." % args.name
+    myRegion = makeregion(args.name, args.tiles, args.tilesize, args.scale, args.lat, args.lon)
+    shape = synthesize(myRegion, args.resolution, args.mix, args.elmax, args.seed)
+    print "Synthetic datasets are %dx%d at %dm" % (shape[1], shape[0], args.resolution)
+
+    current = {'label': args.label, 'revision': revision(), 'host': socket.gethostname(), 'started': time(), 'params': params, 'stages': dict()}
+    if current['label'] is None:
+        current['label'] = current['revision']
+    prepargs = ['--name', args.name] + (['--disable-opencl'] if args.noOCL else [])
+    current['stages']['prepregion'] = runstage('prepregion.py', prepargs, myRegion.reportfile('prepregion'))
+    buildargs = ['--name', args.name, '--rebuild'] + (['--single'] if args.single else [])
+    current['stages']['buildregion'] = runstage('buildregion.py', buildargs, myRegion.reportfile('buildregion'))
+
+    history = loadhistory()
+    if args.baseline is not None:
+        baselines = [run for run in history if run['label'] == args.baseline]
+    else:
+        baselines = [run for run in history if run['params'] == params and run['host'] == current['host']]
+    if baselines:
+        compare(baselines[-1], current)
+    else:
+        print 'No baseline found'
+
+    if args.doHistory:
+        if not os.path.exists(os.path.dirname(historyfile)):
+            os.makedirs(os.path.dirname(historyfile))
+        stream = file(historyfile, 'a')
+        stream.write(json.dumps(current, sort_keys=True) + '\n')
+        stream.close()
+        print "Benchmark recorded in %s" % historyfile
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,27 +2,162 @@
 
 import logging
 logging.basicConfig(level=logging.WARNING)
+import sys
+import subprocess
 from tile import Tile
 from utils import setspawnandsave
+from schematic import Schematic
 import argparse
 import os
-import yaml
-from multiprocessing import Pool
-from itertools import product
+import glob
+import shutil
+import traceback
+from time import time
+from multiprocessing import Pool, cpu_count
+from itertools import product, imap, chain
 from tree import Tree, treeObjs
 from ore import Ore, oreObjs
+from merge import shardtiles, shardchunks, mergeshard
+from mapstore import buildstore
+from tilestats import TileStats
+from regionconfig import RegionConfig
+from runreport import RunReport
+from workqueue import WorkQueue, work
 from pymclevel import mclevel
 
 
-def buildtile(args):
-    """Given a region name and coordinates, build the corresponding tile."""
+# read-only state shared by every tile built in this process
+workerconfigs = dict()
+
+
+def initworker(name):
+    """Loads the region config, schematics and stamps once per process."""
+    # forked workers inherit whatever the parent has already loaded
+    if name in workerconfigs:
+        return
+    config = RegionConfig.load(name)
+    Schematic.preload(config.doSchematics)
+    for tree in treeObjs:
+        tree.compile()
+    for ore in oreObjs:
+        ore.compile()
+    workerconfigs[name] = config
+
+
+def buildtile(args, tiledir=None):
+    """Given a region name and coordinates, build the corresponding tile and return its result."""
     # this should work for single and multi threaded cases
-    (name, tilex, tiley) = args
-    yamlfile = file(os.path.join('regions', name, 'Region.yaml'))
-    myRegion = yaml.load(yamlfile)
-    yamlfile.close()
-    myTile = Tile(myRegion, tilex, tiley)
-    myTile()
+    (name, tilex, tiley, seed, mapstore) = args
+    try:
+        initworker(name)
+        myRegion = workerconfigs[name]
+        starttime = time()
+        myTile = Tile(myRegion, tilex, tiley, seed, mapstore, tiledir)
+        result = myTile()
+        result['elapsed'] = time() - starttime
+    except Exception:
+        # failed tiles are reported back so they can be retried
+        result = {'tilex': tilex, 'tiley': tiley, 'error': traceback.format_exc()}
+    return result
+
+
+def leasedir(task, lease):
+    """Returns the scratch directory in which a worker builds a leased tile."""
+    (name, tilex, tiley) = task[:3]
+    return os.path.join(RegionConfig.regiontop, name, 'Tiles', '%dx%d.lease%s' % (tilex, tiley, lease))
+
+
+def buildleased(task, lease):
+    """Builds a tile leased from a coordinator in its scratch directory."""
+    return buildtile((str(task[0]),) + tuple(task[1:]), leasedir(task, lease))
+
+
+def accepttile(task, lease):
+    """Moves a leased tile accepted by the coordinator into place."""
+    (name, tilex, tiley) = task[:3]
+    tiledir = os.path.join(RegionConfig.regiontop, name, 'Tiles', '%dx%d' % (tilex, tiley))
+    if os.path.isdir(tiledir):
+        shutil.rmtree(tiledir)
+    os.rename(leasedir(task, lease), tiledir)
+
+
+def discardtile(task, lease):
+    """Removes the scratch directory of a leased tile which was not accepted."""
+    scratchdir = leasedir(task, lease)
+    if os.path.isdir(scratchdir):
+        shutil.rmtree(scratchdir)
+
+
+def buildtiles(tiles, pool=None, retries=0):
+    """Yields tile results as they complete, retrying tiles which fail."""
+    for attempt in xrange(retries+1):
+        if pool is None:
+            results = imap(buildtile, tiles)
+        else:
+            results = pool.imap_unordered(buildtile, tiles, 1)
+        failed = []
+        for result in results:
+            if 'error' in result:
+                print "Tile %dx%d failed:\n%s" % (result['tilex'], result['tiley'], result['error'])
+                failed.append([tile for tile in tiles if tile[1:3] == (result['tilex'], result['tiley'])][0])
+            else:
+                yield result
+        if not failed:
+            return
+        tiles = failed
+        if attempt < retries:
+            print "Retrying %d failed tiles..." % len(tiles)
+    raise RuntimeError('%d tiles failed to build, rerun to resume' % len(tiles))
+
+
+def reportcosts(costs, elapsed, count=10):
+    """Prints predicted against actual build time for the slowest tiles."""
+    # predictions are relative so scale them to the actual total
+    totalcost = sum([costs[tile] for tile in elapsed])
+    totaltime = sum(elapsed.values())
+    if totalcost == 0 or totaltime == 0:
+        return
+    factor = totaltime / totalcost
+    print "Tile build times (predicted vs actual):"
+    for tile in sorted(elapsed, key=elapsed.get, reverse=True)[:count]:
+        print "  %dx%d: %.1fs vs %.1fs" % (tile[0], tile[1], costs[tile] * factor, elapsed[tile])
+    error = sum([abs(costs[tile] * factor - elapsed[tile]) for tile in elapsed])
+    print "Mean absolute prediction error: %.1fs per tile" % (error / len(elapsed))
+
+
+def reporttimings(report, tiletimings, shardtimings, processes, count=10):
+    """Prints the slowest tiles and phases and adds all timings to the run report."""
+    if tiletimings:
+        print "Slowest tiles:"
+        totals = dict([(tile, sum(tiletimings[tile]['wall'].values())) for tile in tiletimings])
+        for tile in sorted(totals, key=totals.get, reverse=True)[:count]:
+            timings = tiletimings[tile]
+            phases = sorted(timings['phases'], key=timings['wall'].get, reverse=True)[:3]
+            print "  %dx%d: %.1fs wall, %.1fs cpu, %d blocks, %d KB peak RSS growth (%s)" % (tile[0], tile[1], totals[tile], sum(timings['cpu'].values()), timings['counts'].get('blocks', 0), timings.get('peakrssgrowth', 0), ', '.join(['%s %.1fs' % (phase, timings['wall'][phase]) for phase in phases]))
+        print "Tile phases:"
+        phasewall = dict()
+        phasecpu = dict()
+        for timings in tiletimings.values():
+            for phase in timings['phases']:
+                phasewall[phase] = phasewall.get(phase, 0) + timings['wall'][phase]
+                phasecpu[phase] = phasecpu.get(phase, 0) + timings['cpu'][phase]
+        totalwall = sum(phasewall.values())
+        for phase in sorted(phasewall, key=phasewall.get, reverse=True):
+            print "  %s: %.1fs wall (%.0f%%), %.1fs cpu" % (phase, phasewall[phase], 100 * phasewall[phase] / totalwall if totalwall else 0, phasecpu[phase])
+    # throughput and utilization of the pool while tiles were building
+    buildwall = report.wall.get('build', 0) + report.wall.get('merge', 0)
+    tilewall = sum([sum(timings['wall'].values()) for timings in tiletimings.values()])
+    pool = {'processes': processes, 'tiles': len(tiletimings)}
+    if buildwall > 0:
+        pool['throughput'] = len(tiletimings) / buildwall
+        pool['utilization'] = tilewall / (processes * buildwall)
+        print "Pool: %d processes, %.2f tiles/s, %.0f%% utilization" % (processes, pool['throughput'], 100 * pool['utilization'])
+    print "Region phases:"
+    for phase in report.order:
+        print "  %s: %.1fs wall, %.1fs cpu" % (phase, report.wall[phase], report.cpu[phase])
+    report.data['pool'] = pool
+    report.data['tiles'] = dict([('%dx%d' % tile, tiletimings[tile]) for tile in tiletimings])
+    report.data['shards'] = dict([('r.%d.%d' % shard, shardtimings[shard]) for shard in shardtimings])
 
 
 def main():
@@ -32,20 +167,40 @@ def main():
 
     # parse options and get results
     parser = argparse.ArgumentParser(description='Builds Minecraft worlds from regions.')
-    parser.add_argument('--name', required=True, type=str, help='name of the region to be built')
+    parser.add_argument('--name', type=str, help='name of the region to be built')
     parser.add_argument('--debug', action='store_true', help='enable debug output')
     parser.add_argument('--single', action='store_true', help='enable single-threaded mode for debugging or profiling')
+    parser.add_argument('--seed', default=0, type=int, help='random seed for the region (default 0)')
+    parser.add_argument('--retries', default=2, type=int, help='number of times to retry failed tiles (default 2)')
+    parser.add_argument('--sharedmap', action='store_true', help='decode the map once into a memory-mapped store shared by all workers')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild all tiles even if they have matching checkpoints')
+    parser.add_argument('--coordinator', action='store_true', help='serve tiles to workers on other hosts instead of building them here')
+    parser.add_argument('--bind', default='', type=str, help='address the coordinator listens on (default all)')
+    parser.add_argument('--port', default=8750, type=int, help='port the coordinator listens on (default 8750)')
+    parser.add_argument('--lease', default=300, type=int, help='seconds a worker may hold a tile without renewing (default 300)')
+    parser.add_argument('--workers', default=0, type=int, help='number of local worker processes the coordinator starts (default 0)')
+    parser.add_argument('--worker', metavar='HOST:PORT', type=str, help='build tiles for the coordinator at HOST:PORT')
     args = parser.parse_args()
 
+    # workers get everything they need from the coordinator
+    if args.worker is not None:
+        (host, port) = args.worker.rsplit(':', 1)
+        print "Building tiles for %s..." % args.worker
+        count = work((host, int(port)), buildleased, discard=discardtile)
+        print "Built %d tiles" % count
+        return
+    if args.name is None:
+        parser.error('--name is required unless running as a worker')
+
     # enable debug
     if (args.debug):
         print "Do something!"
 
     # build the region
     print "Building region %s..." % args.name
-    yamlfile = file(os.path.join('regions', args.name, 'Region.yaml'))
-    myRegion = yaml.load(yamlfile)
-    yamlfile.close()
+    report = RunReport('buildregion')
+    report.start('setup')
+    myRegion = RegionConfig.load(args.name)
 
     # exit if map does not exist
     if not os.path.exists(myRegion.mapfile):
@@ -58,8 +213,14 @@ def main():
     ores = dict([(name, list()) for name in oreobjs])
 
     # generate overall world
+    # it is saved right away so each merge shard can drop its region file in
     worlddir = os.path.join('worlds', args.name)
     world = mclevel.MCInfdevOldLevel(worlddir, create=True)
+    world.saveInPlace()
+    world = False
+    regiondir = os.path.join(worlddir, 'region')
+    if not os.path.exists(regiondir):
+        os.makedirs(regiondir)
     peak = [0, 0, 0]
 
     # generate individual tiles
@@ -67,55 +228,154 @@ def main():
     tileyrange = xrange(myRegion.tiles['ymin'], myRegion.tiles['ymax'])
     name = myRegion.name
     tiles = [(name, x, y) for x, y in product(tilexrange, tileyrange)]
+
+    # most expensive tiles go first so stragglers do not hold up the pool
+    costs = None
+    if os.path.exists(myRegion.tilestatsfile):
+        tilestats = TileStats.load(myRegion.tilestatsfile)
+        costs = dict([((x, y), tilestats.cost(x, y, myRegion.doSchematics)) for (name, x, y) in tiles])
+        tiles.sort(key=lambda tile: costs[(tile[1], tile[2])], reverse=True)
+    else:
+        print "No tile statistics found, run prepregion to enable cost-aware scheduling"
+    elapsed = dict()
+
+    # each destination region file is merged as soon as all of its tiles are built
+    shards = shardtiles(tiles, myRegion.tilesize)
+    pending = dict([(shard, set(shards[shard])) for shard in shards])
+    inventory = dict([(shard, list()) for shard in shards])
+    tileshards = dict()
+    for shard in shards:
+        for tile in shards[shard]:
+            tileshards.setdefault(tile, []).append(shard)
+    ready = []
+
+    # workers read their windows from one decoded copy of the map
+    mapstore = None
+    if args.sharedmap:
+        report.start('mapstore')
+        mapstore = buildstore(myRegion.mapfile)
+        report.start('setup')
+
+    # tiles which completed with a matching fingerprint are not built again
+    checkpoints = []
+    tobuild = []
+    for (name, x, y) in tiles:
+        result = None if args.rebuild else Tile(myRegion, x, y, args.seed, mapstore).checkpoint()
+        if result is None:
+            tobuild.append((name, x, y, args.seed, mapstore))
+        else:
+            checkpoints.append(result)
+    if checkpoints:
+        print "Resuming with %d tiles already built..." % len(checkpoints)
+
     if args.single:
         # single process version - works
-        for tile in tiles:
-            buildtile(tile)
+        pool = None
+        processes = 1
     else:
         # multi-process ... let's see...
-        pool = Pool()
-        pool.map(buildtile, tiles)
+        # shared state is loaded before forking so workers start ready
+        initworker(name)
+        pool = Pool(initializer=initworker, initargs=(name,))
+        processes = cpu_count()
+    if args.coordinator:
+        # tiles are built by workers sharing the regions and worlds directories
+        # each in its own scratch directory, moved into place when accepted
+        for scratchdir in glob.glob(os.path.join(myRegion.regiondir, 'Tiles', '*.lease*')):
+            shutil.rmtree(scratchdir)
+        queue = WorkQueue(tobuild, (args.bind, args.port), args.lease, args.retries, accepttile).start()
+        print "Serving %d tiles on port %d..." % (len(tobuild), queue.address[1])
+        command = [sys.executable, os.path.abspath(__file__), '--worker', 'localhost:%d' % queue.address[1]]
+        workers = [subprocess.Popen(command) for dummy in xrange(args.workers)]
+        results = chain(checkpoints, queue)
+    else:
+        results = chain(checkpoints, buildtiles(tobuild, pool, args.retries))
+    tiletimings = dict()
+    shardtimings = dict()
+
+    # results are reduced as they arrive while the rest of the tiles build
+    print "Building and merging %d tiles into one world..." % len(tiles)
+    report.start('build')
+    for numdone, result in enumerate(results, 1):
+        tile = (result['tilex'], result['tiley'])
+        if 'elapsed' in result:
+            elapsed[tile] = result['elapsed']
+            tiletimings[tile] = result['timings']
+        if (result['peak'][1] > peak[1]):
+            peak = result['peak']
+        for treetype in result['trees']:
+            trees.setdefault(treetype, []).extend(result['trees'][treetype])
+        if myRegion.doOre:
+            for oretype in result['ores']:
+                ores.setdefault(oretype, []).extend(result['ores'][oretype])
+        for (rx, rz) in tileshards[tile]:
+            pending[(rx, rz)].remove(tile)
+            inventory[(rx, rz)].append((tile[0], tile[1], shardchunks(result['chunks'], rx, rz)))
+            if not pending[(rx, rz)]:
+                ready.append((name, rx, rz, inventory.pop((rx, rz))))
+        # the pool is still busy, so merge ready shards here
+        if numdone < len(tiles):
+            report.start('merge')
+            while ready:
+                shardresult = mergeshard(ready.pop(0))
+                shardtimings[(shardresult['rx'], shardresult['rz'])] = shardresult['timings']
+            report.start('build')
+
+    if args.coordinator:
+        report.data['workqueue'] = queue.summary()
+        queue.stop()
+        for worker in workers:
+            worker.wait()
+
+    # whatever is left is merged in parallel
+    report.start('merge')
+    if args.single:
+        shardresults = [mergeshard(shardarg) for shardarg in ready]
+    else:
+        shardresults = pool.map(mergeshard, ready)
         pool.close()
         pool.join()
+    for shardresult in shardresults:
+        shardtimings[(shardresult['rx'], shardresult['rz'])] = shardresult['timings']
+    world = mclevel.MCInfdevOldLevel(worlddir, create=False)
 
-    # merge individual worlds into it
-    print "Merging %d tiles into one world..." % len(tiles)
-    for tile in tiles:
-        (name, x, y) = tile
-        tiledir = os.path.join('regions', name, 'Tiles', '%dx%d' % (x, y))
-        tilefile = file(os.path.join(tiledir, 'Tile.yaml'))
-        newtile = yaml.load(tilefile)
-        tilefile.close()
-        if (newtile.peak[1] > peak[1]):
-            peak = newtile.peak
-        for treetype in newtile.trees:
-            trees.setdefault(treetype, []).extend(newtile.trees[treetype])
-        if myRegion.doOre:
-            for oretype in newtile.ores:
-                ores.setdefault(oretype, []).extend(newtile.ores[oretype])
-        tileworld = mclevel.MCInfdevOldLevel(tiledir, create=False)
-        world.copyBlocksFrom(tileworld, tileworld.bounds, tileworld.bounds.origin)
-        tileworld = False
+    # compare predicted and actual tile times
+    if costs is not None:
+        reportcosts(costs, elapsed)
 
     # plant trees in our world
+    report.start('trees')
     print "Planting %d trees at the region level..." % sum([len(trees[treetype]) for treetype in trees])
     Tree.placetreesinregion(trees, treeobjs, world)
 
     # deposit ores in our world
     if myRegion.doOre:
+        report.start('ores')
         print "Depositing %d ores at the region level..." % sum([len(ores[oretype]) for oretype in ores])
         Ore.placeoreinregion(ores, oreobjs, world)
 
     # replace all 'end stone' with stone
+    report.start('endstone')
     print "Replacing all 'end stone' with stone..."
     EndStoneID = world.materials["End Stone"].ID
     StoneID = world.materials["Stone"].ID
     for xpos, zpos in world.allChunks:
         chunk = world.getChunk(xpos, zpos)
-        chunk.Blocks[chunk.Blocks == EndStoneID] = StoneID
+        endstone = chunk.Blocks == EndStoneID
+        if endstone.any():
+            chunk.Blocks[endstone] = StoneID
+            chunk.chunkChanged()
 
     # tie up loose ends
+    report.start('save')
     setspawnandsave(world, peak)
 
+    # report where the time went
+    report.stop()
+    reporttimings(report, tiletimings, shardtimings, processes)
+    report.data['tilecount'] = len(tiles)
+    report.data['resumed'] = len(checkpoints)
+    report.save(myRegion.reportfile('buildregion'))
+
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+import logging
+logging.basicConfig(level=logging.WARNING)
+import sys
+import os
+import json
+import socket
+import argparse
+from time import time
+import numpy as np
+
+
+class Calibration(object):
+    """
+    Per-host timings of each map-building stage on each backend.
+
+    Stages with an OpenCL path are timed both on OpenCL and on their
+    CPU engine (NumPy for elev, cKDTree for idt and crust, GDAL for
+    bathy) at a few array sizes.  The faster backend for any other
+    size is chosen by interpolating between the measured sizes.
+
+    """
+
+    cachedir = os.path.abspath(os.path.join('cache', 'calibration'))
+
+    stages = ['elev', 'crust', 'idt', 'bathy']
+
+    # edge lengths of the square arrays timed
+    sizes = [64, 128, 256, 512]
+
+    # bathy needs a border this wide
+    maxdepth = 16
+
+    def __init__(self, timings=None, host=None):
+        # timings[stage][backend] is a list of [elements, seconds]
+        if timings is None:
+            timings = dict()
+        if host is None:
+            host = socket.gethostname()
+        self.timings = timings
+        self.host = host
+
+    @staticmethod
+    def filename(host=None):
+        """Returns the calibration file for a host."""
+        if host is None:
+            host = socket.gethostname()
+        return os.path.join(Calibration.cachedir, '%s.json' % host)
+
+    @staticmethod
+    def load(host=None):
+        """Returns the calibration for a host or None if it has not been calibrated."""
+        filename = Calibration.filename(host)
+        if not os.path.exists(filename):
+            return None
+        stream = file(filename, 'r')
+        values = json.load(stream)
+        stream.close()
+        return Calibration(values['timings'], str(values['host']))
+
+    def save(self):
+        """Writes the calibration as JSON."""
+        if not os.path.exists(Calibration.cachedir):
+            os.makedirs(Calibration.cachedir)
+        filename = Calibration.filename(self.host)
+        stream = file(filename, 'w')
+        json.dump({'host': self.host, 'timings': self.timings}, stream, indent=2, sort_keys=True)
+        stream.close()
+        return filename
+
+    @staticmethod
+    def workload(stage, size, wantCL):
+        """Returns a function running one stage on a square array of the given size."""
+        randomstate = np.random.RandomState(0)
+        if stage == 'elev':
+            from elev import Elev
+            elarray = randomstate.uniform(-100, 3000, (size, size)).astype(np.float32)
+            engine = Elev(elarray, wantCL=wantCL)
+            return lambda: engine(0, 6, 64)
+        if stage == 'crust':
+            from crust import Crust
+            engine = Crust(size, size, wantCL=wantCL)
+            return lambda: engine()
+        if stage == 'idt':
+            from idt import IDT
+            # landcover is resampled from a coarser grid
+            coarse = max(size // 2, 1)
+            coords = np.array([(x*2, y*2) for y in xrange(coarse) for x in xrange(coarse)], dtype=np.float32)
+            values = randomstate.randint(11, 96, len(coords)).astype(np.int32)
+            base = np.array([(x, y) for y in xrange(size) for x in xrange(size)], dtype=np.float32)
+            engine = IDT(coords, values, wantCL=wantCL)
+            return lambda: engine(base, (size, size))
+        if stage == 'bathy':
+            from bathy import Bathy
+            # water with scattered islands
+            lcarray = np.where(randomstate.uniform(size=(size, size)) < 0.02, 41, 11).astype(np.int32)
+            engine = Bathy(lcarray, [0, 1, 0, 0, 0, -1], '', wantCL=wantCL)
+            return lambda: engine(Calibration.maxdepth)
+        raise AttributeError('unknown stage %s' % stage)
+
+    def run(self, stages=None, sizes=None, verbose=True):
+        """Times every available backend of each stage at each size."""
+        from clmanager import CLManager
+        if stages is None:
+            stages = Calibration.stages
+        if sizes is None:
+            sizes = Calibration.sizes
+        backends = ['cpu']
+        if CLManager.get() is not None:
+            backends.insert(0, 'opencl')
+        for stage in stages:
+            self.timings[stage] = dict()
+            for backend in backends:
+                self.timings[stage][backend] = []
+                for size in sizes:
+                    if stage == 'bathy' and size <= 2 * Calibration.maxdepth:
+                        continue
+                    func = Calibration.workload(stage, size, backend == 'opencl')
+                    # a warm-up run keeps compilation out of the timings
+                    func()
+                    starttime = time()
+                    func()
+                    elapsed = time() - starttime
+                    self.timings[stage][backend].append([size*size, elapsed])
+                    if verbose:
+                        print '%s on %s: %d elements in %.3f seconds' % (stage, backend, size*size, elapsed)
+
+    @staticmethod
+    def estimate(points, elements):
+        """Returns the interpolated time for a number of elements."""
+        points = sorted(points)
+        if elements <= points[0][0]:
+            (low, high) = (points[0], points[0])
+        elif elements >= points[-1][0]:
+            (low, high) = (points[-1], points[-1])
+        else:
+            for (low, high) in zip(points[:-1], points[1:]):
+                if low[0] <= elements <= high[0]:
+                    break
+        if low[0] == high[0]:
+            # outside the measured range each element costs the same
+            return low[1] * elements / low[0]
+        fraction = (elements - low[0]) / float(high[0] - low[0])
+        return low[1] + fraction * (high[1] - low[1])
+
+    def wantCL(self, stage, elements, default=True):
+        """Returns True if OpenCL is the faster backend for this stage and size."""
+        try:
+            stagetimings = self.timings[stage]
+            clpoints = stagetimings['opencl']
+            cpupoints = stagetimings['cpu']
+        except KeyError:
+            return default
+        if not clpoints or not cpupoints:
+            return default
+        return Calibration.estimate(clpoints, elements) < Calibration.estimate(cpupoints, elements)
+
+
+def main():
+    """Times each backend of each map-building stage on this host."""
+    parser = argparse.ArgumentParser(description='Calibrates backend selection for preparing regions.')
+    parser.add_argument('--stages', nargs='+', choices=Calibration.stages, default=Calibration.stages, help='stages to calibrate')
+    parser.add_argument('--sizes', nargs='+', type=int, default=Calibration.sizes, help='edge lengths of the arrays timed')
+
+    args = parser.parse_args()
+
+    print "Calibrating %s on %s..." % (', '.join(args.stages), socket.gethostname())
+    calibration = Calibration.load()
+    if calibration is None:
+        calibration = Calibration()
+    calibration.run(args.stages, args.sizes)
+    print "Calibration saved to %s" % calibration.save()
+
+if __name__ == '__main__':
+    sys.exit(main())
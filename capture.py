@@ -0,0 +1,71 @@
+# capture module
+import os
+import json
+from time import time
+import numpy as np
+
+# captures are directories of raw arrays with a JSON sidecar
+capturesdir = 'captures'
+sidecar = 'capture.json'
+
+
+def capturepath(name):
+    """Returns the directory for a named capture."""
+    return os.path.join(capturesdir, name)
+
+
+def save(name, stage, arrays, params):
+    """Writes the input arrays and parameters of one stage run."""
+    dirname = capturepath(name)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    print 'Capturing to %s...' % dirname
+    shapes = dict()
+    for key in arrays:
+        array = np.asarray(arrays[key])
+        np.save(os.path.join(dirname, '%s.npy' % key), array)
+        shapes[key] = {'shape': list(array.shape), 'dtype': array.dtype.str}
+    stream = file(os.path.join(dirname, sidecar), 'w')
+    json.dump({'stage': stage, 'created': time(), 'arrays': shapes, 'params': params}, stream, indent=2, sort_keys=True)
+    stream.close()
+    return dirname
+
+
+def load(dirname):
+    """Returns the stage, memory-mapped input arrays and parameters of a capture."""
+    stream = file(os.path.join(dirname, sidecar), 'r')
+    values = json.load(stream)
+    stream.close()
+    arrays = dict([(str(key), np.load(os.path.join(dirname, '%s.npy' % key), mmap_mode='r')) for key in values['arrays']])
+    params = dict([(str(key), value) for (key, value) in values['params'].items()])
+    return (str(values['stage']), arrays, params)
+
+
+def compare(expected, actual, allowed_error_percentage, tolerance=0.0001, verbose=True):
+    """Returns the number of mismatches, raising AssertionError if there are too many."""
+    expected = np.asarray(expected)
+    actual = np.asarray(actual)
+    if expected.shape != actual.shape:
+        raise AssertionError('shapes %s and %s differ' % (expected.shape, actual.shape))
+    mismatches = np.abs(expected.astype(np.float64) - actual.astype(np.float64)) > tolerance
+    nomatch = int(np.count_nonzero(mismatches))
+    lenbase = max(expected.size, 1)
+    nomatchmsg = '%d of %d (%d%%) failed to match' % (nomatch, lenbase, 100*nomatch/lenbase)
+    if nomatch > int(allowed_error_percentage*0.01*lenbase):
+        if verbose:
+            for index in np.argwhere(mismatches)[:9]:
+                index = tuple(index)
+                print 'no match at ', index
+                print ' expected: ', expected[index]
+                print ' actual: ', actual[index]
+        raise AssertionError(nomatchmsg)
+    if verbose:
+        print nomatchmsg
+    return nomatch
+
+
+def diffimage(expected, actual, filename):
+    """Saves an image of the differences, centered on 128."""
+    import Image
+    diffarr = np.clip(128 + np.asarray(expected, dtype=np.int32) - np.asarray(actual, dtype=np.int32), 0, 255).astype(np.uint8)
+    Image.fromarray(diffarr).save(filename)
@@ -0,0 +1,158 @@
+# OpenCL device manager
+import os
+import hashlib
+import numpy as np
+
+try:
+    import pyopencl as cl
+    hasCL = True
+except ImportError:
+    hasCL = False
+
+
+class CLManager(object):
+    """
+    One OpenCL context and queue per process, shared by every
+    OpenCL-backed stage.  Devices are chosen without prompting, GPUs
+    first, so CPU runtimes such as pocl work too.  Compiled programs
+    are cached on disk keyed by source and device.
+
+    """
+
+    # kernel sources live next to this module
+    sourcedir = os.path.dirname(os.path.abspath(__file__))
+    cachedir = os.path.abspath(os.path.join('cache', 'opencl'))
+
+    # managers keyed by platform number
+    managers = dict()
+
+    def __init__(self, platform_num=None):
+        platforms = cl.get_platforms()
+        if platform_num is not None:
+            candidates = [platforms[platform_num]]
+        else:
+            candidates = platforms
+        devices = []
+        for devtype in [cl.device_type.GPU, cl.device_type.ALL]:
+            for platform in candidates:
+                try:
+                    devices = platform.get_devices(device_type=devtype)
+                except cl.Error:
+                    devices = []
+                if devices:
+                    break
+            if devices:
+                break
+        if not devices:
+            raise RuntimeError('no OpenCL devices found')
+        # one device keeps buffers and queue on the same device
+        self.devices = devices[:1]
+        self.context = cl.Context(self.devices)
+        self.queue = cl.CommandQueue(self.context)
+        # a second queue lets one chunk transfer while another computes
+        self.queues = [self.queue, cl.CommandQueue(self.context)]
+        self.programs = dict()
+
+    @staticmethod
+    def get(platform_num=None):
+        """Returns the manager for this process or None if OpenCL is unusable."""
+        if not hasCL:
+            return None
+        if platform_num not in CLManager.managers:
+            try:
+                CLManager.managers[platform_num] = CLManager(platform_num)
+            except (cl.Error, RuntimeError, IndexError), e:
+                print 'warning: unable to set up OpenCL: %s' % e
+                CLManager.managers[platform_num] = None
+        return CLManager.managers[platform_num]
+
+    def devicekey(self, source):
+        """Returns the cache key for a program source on this manager's devices."""
+        digest = hashlib.sha1(source)
+        digest.update(cl.VERSION_TEXT)
+        for device in self.devices:
+            digest.update('\0'.join([device.platform.name, device.platform.version, device.name, device.version, device.driver_version]))
+        return digest.hexdigest()
+
+    def program(self, name):
+        """Returns the built program for name.cl, using cached binaries when possible, or None if it does not build."""
+        if name in self.programs:
+            return self.programs[name]
+        stream = open(os.path.join(CLManager.sourcedir, '%s.cl' % name), 'r')
+        source = stream.read()
+        stream.close()
+        cachefile = os.path.join(CLManager.cachedir, '%s-%s.bin' % (name, self.devicekey(source)))
+        program = None
+        if os.path.exists(cachefile):
+            stream = open(cachefile, 'rb')
+            binary = stream.read()
+            stream.close()
+            try:
+                program = cl.Program(self.context, self.devices, [binary] * len(self.devices)).build()
+            except cl.Error:
+                # stale or foreign binaries are rebuilt from source
+                program = None
+        if program is None:
+            try:
+                program = cl.Program(self.context, source).build(devices=self.devices)
+            except cl.Error, e:
+                # callers fall back to their CPU code
+                print 'warning: unable to build %s.cl: %s' % (name, e)
+                self.programs[name] = None
+                return None
+            for device in self.devices:
+                buildlog = program.get_build_info(device, cl.program_build_info.LOG)
+                if (len(buildlog) > 1):
+                    print 'Build log for device', device, ':\n', buildlog
+            if not os.path.exists(CLManager.cachedir):
+                os.makedirs(CLManager.cachedir)
+            tmpname = '%s.tmp%d' % (cachefile, os.getpid())
+            stream = open(tmpname, 'wb')
+            stream.write(program.get_info(cl.program_info.BINARIES)[0])
+            stream.close()
+            os.rename(tmpname, cachefile)
+        self.programs[name] = program
+        return program
+
+    def worksizes(self, kernel):
+        """Returns local and global sizes for a kernel keyed by device."""
+        local_size = {}
+        global_size = {}
+        # Groups should be overcommitted.
+        # For now, use 3 (48 cores / 16 cores per halfwarp) * 2
+        for device in self.devices:
+            work_group_size = kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+            num_groups_for_1d = device.max_compute_units * 3 * 2
+            local_size[device] = (work_group_size,)
+            global_size[device] = (num_groups_for_1d * work_group_size,)
+        return (local_size, global_size)
+
+    def stream(self, launch, source, results, chunksize):
+        """
+        Runs a kernel over source a chunk at a time, writing each
+        chunk's results straight into the matching slice of results.
+
+        Two buffer pairs alternate between two queues with non-blocking
+        copies, so one chunk uploads and downloads while the other
+        runs.  launch(queue, retvals_buf, chunk_buf, lenchunk) enqueues
+        the kernel and returns its event.
+
+        """
+        lensource = len(source)
+        chunksize = max(1, min(chunksize, lensource))
+        mf = cl.mem_flags
+        slots = [(queue,
+                  cl.Buffer(self.context, mf.WRITE_ONLY, results[:chunksize].nbytes),
+                  cl.Buffer(self.context, mf.READ_ONLY, source[:chunksize].nbytes))
+                 for queue in self.queues]
+        events = []
+        for (num, start) in enumerate(xrange(0, lensource, chunksize)):
+            stop = min(start+chunksize, lensource)
+            (queue, retvals_buf, chunk_buf) = slots[num % len(slots)]
+            # in-order queues keep a slot's buffers from being reused early
+            cl.enqueue_copy(queue, chunk_buf, source[start:stop], is_blocking=False)
+            launch(queue, retvals_buf, chunk_buf, np.uint32(stop-start))
+            events.append(cl.enqueue_copy(queue, results[start:stop], retvals_buf, is_blocking=False))
+        if events:
+            cl.wait_for_events(events)
+        return results
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+import logging
+logging.basicConfig(level=logging.WARNING)
+import sys
+import os
+import hashlib
+import argparse
+from multiprocessing import Pool
+from itertools import chain
+import numpy as np
+from utils import names
+from palette import Palette
+from terrain import Terrain
+from schematic import Schematic
+from tree import treeObjs
+from ore import oreObjs
+from pymclevel import mclevel
+
+# worlds opened by this process
+openworlds = dict()
+
+
+def openworld(path):
+    """Returns the world at path, opening it once per process."""
+    if path not in openworlds:
+        openworlds[path] = mclevel.fromFile(path)
+    return openworlds[path]
+
+
+def terrainblocks():
+    """Returns the IDs of blocks the terrain layers and schematics place whatever the seed."""
+    tables = Terrain.tables
+    blockIDs = set(tables['block'].ravel()) | set(tables['patchblock'].ravel())
+    blockIDs.update([Palette.ids['End Stone'], Palette.ids['Bedrock']])
+    for (name, nameoffset, layout, offset) in Terrain.schematics.values():
+        blockIDs.update(np.unique(Schematic.expand(layout)[0]))
+        filename = os.path.join('schematics', '%s.schematic' % name)
+        if os.path.exists(filename):
+            blockIDs.update(np.unique(Schematic.readfile(filename)[0]))
+    return set([int(blockID) for blockID in blockIDs])
+
+
+def randomizedblocks():
+    """Returns the names of blocks placed by randomized features: trees, plants and ores the terrain never places."""
+    blocks = set(['Wood', 'Leaves'])
+    for rule in Terrain.rules.values():
+        for feature in ['trees', 'plants']:
+            if feature in rule:
+                for block in rule[feature][1]:
+                    blocks.add(block[0] if isinstance(block, tuple) else block)
+    blocks.update([tree.name for tree in treeObjs if tree.name in Palette.ids])
+    # ores such as dirt and gravel are also terrain, so differences there are real
+    terrain = terrainblocks()
+    blocks.update([ore.name for ore in oreObjs if ore.name in Palette.ids and Palette.ids[ore.name] not in terrain])
+    return sorted([block for block in blocks if block in Palette.ids])
+
+
+def hashchunks(args):
+    """Returns the digests of the blocks and data of some chunks of a world."""
+    (path, chunks) = args
+    world = openworld(path)
+    digests = dict()
+    for (cx, cz) in chunks:
+        chunk = world.getChunk(cx, cz)
+        digest = hashlib.sha1(np.ascontiguousarray(chunk.Blocks).tostring())
+        digest.update(np.ascontiguousarray(chunk.Data).tostring())
+        digests[(cx, cz)] = digest.hexdigest()
+    return digests
+
+
+def diffchunks(args):
+    """Returns block counts and differences for chunks present in both worlds."""
+    (patha, pathb, chunks, ignored) = args
+    worlda = openworld(patha)
+    worldb = openworld(pathb)
+    ignoremask = np.zeros(256, dtype=bool)
+    ignoremask[list(ignored)] = True
+    result = {'blocks': 0, 'differing': 0, 'ignored': 0, 'deltas': np.zeros(256, dtype=np.int64), 'chunks': dict()}
+    for (cx, cz) in chunks:
+        chunka = worlda.getChunk(cx, cz)
+        chunkb = worldb.getChunk(cx, cz)
+        blocksa = np.asarray(chunka.Blocks, dtype=np.uint8)
+        blocksb = np.asarray(chunkb.Blocks, dtype=np.uint8)
+        differs = (blocksa != blocksb) | (np.asarray(chunka.Data) != np.asarray(chunkb.Data))
+        # a difference is ignored if either world has an ignored block there
+        ignore = differs & (ignoremask[blocksa] | ignoremask[blocksb])
+        numdiffers = int(np.count_nonzero(differs))
+        numignored = int(np.count_nonzero(ignore))
+        result['blocks'] += blocksa.size
+        result['differing'] += numdiffers - numignored
+        result['ignored'] += numignored
+        counted = differs & ~ignore
+        result['deltas'] += np.bincount(blocksb[counted], minlength=256) - np.bincount(blocksa[counted], minlength=256)
+        result['chunks'][(cx, cz)] = numdiffers - numignored
+    return result
+
+
+def byregion(chunks):
+    """Groups chunk positions by the region file holding them."""
+    groups = dict()
+    for (cx, cz) in chunks:
+        groups.setdefault((cx >> 5, cz >> 5), []).append((cx, cz))
+    return groups.values()
+
+
+def main():
+    """Compares two generated worlds chunk by chunk."""
+    parser = argparse.ArgumentParser(description='Compares the blocks of two Minecraft worlds.')
+    parser.add_argument('expected', type=str, help='world directory to compare against')
+    parser.add_argument('actual', type=str, help='world directory being checked')
+    parser.add_argument('--tolerance', default=0.0, type=float, help='fraction of blocks allowed to differ (default 0)')
+    parser.add_argument('--ignore', default='', type=str, help='comma-separated block names whose differences are ignored')
+    parser.add_argument('--randomized', action='store_true', help='ignore differences in trees, plants and ores, as when seeds differ')
+    parser.add_argument('--show', default=10, type=int, help='number of differing chunks to list (default 10)')
+    parser.add_argument('--single', action='store_true', help='compare in a single process')
+    args = parser.parse_args()
+
+    ignorenames = [block for block in args.ignore.split(',') if block]
+    if args.randomized:
+        ignorenames += randomizedblocks()
+    try:
+        ignored = set([Palette.ids[block] for block in ignorenames])
+    except KeyError, e:
+        print 'Unknown block name %s' % e
+        return 2
+
+    chunksa = set(openworld(args.expected).allChunks)
+    chunksb = set(openworld(args.actual).allChunks)
+    missing = sorted(chunksa - chunksb)
+    extra = sorted(chunksb - chunksa)
+    common = sorted(chunksa & chunksb)
+    print "Comparing %d chunks..." % len(common)
+
+    if args.single:
+        pool = None
+        mapper = map
+    else:
+        pool = Pool()
+        mapper = pool.map
+
+    # chunks are hashed a region file at a time in each world
+    groups = byregion(common)
+    digestsa = dict(chain(*[digests.items() for digests in mapper(hashchunks, [(args.expected, group) for group in groups])]))
+    digestsb = dict(chain(*[digests.items() for digests in mapper(hashchunks, [(args.actual, group) for group in groups])]))
+    changed = [pos for pos in common if digestsa[pos] != digestsb[pos]]
+
+    # only chunks whose digests differ are compared block by block
+    totals = {'blocks': 0, 'differing': 0, 'ignored': 0, 'deltas': np.zeros(256, dtype=np.int64), 'chunks': dict()}
+    for result in mapper(diffchunks, [(args.expected, args.actual, group, ignored) for group in byregion(changed)]):
+        for key in ['differing', 'ignored', 'deltas']:
+            totals[key] = totals[key] + result[key]
+        totals['chunks'].update(result['chunks'])
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if common:
+        chunk = openworld(args.expected).getChunk(*common[0])
+        totals['blocks'] = len(common) * chunk.Blocks.size
+
+    if missing:
+        print "%d chunks missing, such as %s" % (len(missing), missing[:args.show])
+    if extra:
+        print "%d unexpected chunks, such as %s" % (len(extra), extra[:args.show])
+    print "%d of %d chunks differ" % (len(changed), len(common))
+    worst = sorted([(count, pos) for (pos, count) in totals['chunks'].items() if count > 0], reverse=True)
+    for (count, pos) in worst[:args.show]:
+        print "  chunk %d,%d: %d blocks differ" % (pos[0], pos[1], count)
+    if totals['differing'] or totals['ignored']:
+        print "Block changes (actual minus expected):"
+        for blockID in np.nonzero(totals['deltas'])[0]:
+            print "  %-24s %+d" % (names(int(blockID)), totals['deltas'][blockID])
+    fraction = totals['differing'] / float(max(totals['blocks'], 1))
+    print "%d blocks differ (%.4f%%), %d differences ignored" % (totals['differing'], 100 * fraction, totals['ignored'])
+
+    if missing or extra or fraction > args.tolerance:
+        print "Worlds do not match"
+        return 1
+    print "Worlds match"
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
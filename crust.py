@@ -24,6 +24,6 @@ class Crust(object):
         self.base = np.array([(z, x) for z, x in product(xrange(zsize), xrange(xsize))], dtype=np.float32)
         self.idt = IDT(coords, values, wantCL=wantCL)
 
-    def __call__(self, pickle_name=None):
-        retval = self.idt(self.base, self.shape, majority=False, pickle_name=pickle_name)
+    def __call__(self, nnear=None, eps=0.0, capture_name=None):
+        retval = self.idt(self.base, self.shape, nnear=nnear, majority=False, eps=eps, capture_name=capture_name)
         return retval
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+import logging
+logging.basicConfig(level=logging.WARNING)
+import sys
+import os
+import argparse
+import numpy as np
+from osgeo import gdal
+from osgeo.gdalconst import GDT_Int16, GA_ReadOnly
+from regionconfig import RegionConfig
+from tilestats import TileStats
+from runreport import RunReport
+
+
+def blocks(array, factor):
+    """Returns the array with each factor x factor block gathered on the last axis."""
+    (rows, cols) = array.shape
+    return array.reshape(rows // factor, factor, cols // factor, factor).swapaxes(1, 2).reshape(rows // factor, cols // factor, factor * factor)
+
+
+def blockmode(array, factor):
+    """Returns the most common value of each block, the lowest on ties."""
+    blocked = blocks(array, factor)
+    values = np.unique(blocked)
+    counts = np.array([(blocked == value).sum(axis=-1) for value in values])
+    return values[counts.argmax(axis=0)]
+
+
+def blockmean(array, factor):
+    """Returns the rounded mean value of each block."""
+    return np.round(blocks(array, factor).mean(axis=-1)).astype(array.dtype)
+
+
+def borderarray(base, factor, lcarray, maxdepth):
+    """
+    Returns the derived landcover surrounded by a maxdepth border for bathy.
+
+    A regular prepare at the coarser scale reads maxdepth of its
+    columns beyond the region, which is factor times more ground than
+    the base region kept.  The base border, where it was saved, fills
+    as much as it covers, and the rest repeats the outermost column,
+    so water touching that outer edge is taken to extend outward.
+    Depths near the region edge may therefore differ from a regular
+    prepare.
+
+    """
+    inner = 0
+    if os.path.exists(base.borderfile):
+        borderds = gdal.Open(base.borderfile, GA_ReadOnly)
+        border = borderds.GetRasterBand(1).ReadAsArray()
+        borderds = None
+        # the base border is maxdepth base columns wide
+        inner = base.maxdepth // factor
+        trim = base.maxdepth - inner * factor
+        if trim > 0:
+            border = border[trim:-trim, trim:-trim]
+        border = blockmode(border, factor)
+    else:
+        border = lcarray
+    deptharray = np.pad(border, maxdepth - inner, mode='edge')
+    # the interior comes from the translated map landcover
+    deptharray[maxdepth:-maxdepth, maxdepth:-maxdepth] = lcarray
+    return deptharray
+
+
+def derive(base, factor, name=None, wantCL=None, report=None):
+    """Writes a prepared map for the base region at factor times its scale and returns its config."""
+    if report is None:
+        report = RunReport('derive')
+    # tiles keep their extents, so each one holds fewer columns
+    if factor < 2 or base.tilesize % (16 * factor) != 0:
+        raise AttributeError('tilesize %d cannot be divided by factor %d into whole chunks' % (base.tilesize, factor))
+    if name is None:
+        name = '%s-x%d' % (base.name, factor)
+    values = dict([(key, getattr(base, key)) for key in RegionConfig.keys])
+    values.update({'name': name, 'tilesize': base.tilesize // factor, 'scale': base.scale * factor})
+    derived = RegionConfig(**values)
+    if not os.path.exists(derived.regiondir):
+        os.makedirs(derived.regiondir)
+
+    report.start('read')
+    baseds = gdal.Open(base.mapfile, GA_ReadOnly)
+    (basex, basey) = (baseds.RasterXSize, baseds.RasterYSize)
+    geotrans = list(baseds.GetGeoTransform())
+    projection = baseds.GetProjection()
+    bands = dict([(key, baseds.GetRasterBand(RegionConfig.rasters[key]).ReadAsArray()) for key in RegionConfig.rasters])
+    baseds = None
+
+    # landcover is categorical, elevation is averaged and
+    # crust is random so any column of the block will do
+    report.start('landcover')
+    lcarray = blockmode(bands['landcover'], factor)
+    report.start('elev')
+    elarray = blockmean(bands['elevation'], factor)
+    report.start('crust')
+    crustarray = bands['crust'][::factor, ::factor]
+
+    # depth is measured in columns, so it is recomputed on the new grid
+    report.start('bathy')
+    from bathy import Bathy
+    if wantCL is None:
+        from calibrate import Calibration
+        calibration = Calibration.load()
+        wantCL = True if calibration is None else calibration.wantCL('bathy', lcarray.size)
+    maxdepth = derived.maxdepth
+    newscale = geotrans[1] * factor
+    depthgeotrans = [geotrans[0] - maxdepth * newscale, newscale, 0, geotrans[3] + maxdepth * newscale, 0, -1 * newscale]
+    deptharray = borderarray(base, factor, lcarray, maxdepth)
+    bathyarray = Bathy(deptharray, depthgeotrans, projection, wantCL=wantCL)(maxdepth)
+
+    report.start('write')
+    driver = gdal.GetDriverByName('GTiff')
+    mapds = driver.Create(derived.mapfile, basex // factor, basey // factor, len(RegionConfig.rasters), GDT_Int16)
+    mapds.SetGeoTransform([geotrans[0], newscale, 0, geotrans[3], 0, -1 * newscale])
+    mapds.SetProjection(projection)
+    for (key, array) in [('landcover', lcarray), ('elevation', elarray), ('bathy', bathyarray), ('crust', crustarray)]:
+        mapds.GetRasterBand(RegionConfig.rasters[key]).WriteArray(array)
+    mapds = None
+
+    report.start('stats')
+    tilestats = TileStats(derived.tiles, derived.tilesize)
+    tilestats.addelevation(elarray)
+    tilestats.addlandcover(lcarray)
+    tilestats.save(derived.tilestatsfile)
+    derived.save()
+    report.stop()
+    return derived
+
+
+def main():
+    """Derives coarser prepared regions from a prepared region."""
+    parser = argparse.ArgumentParser(description='Derives prepared regions at coarser scales without downloading or preparing again.')
+    parser.add_argument('--name', required=True, type=str, help='name of the prepared region')
+    parser.add_argument('--factors', required=True, type=int, nargs='+', help='scale multipliers, each dividing the tilesize into whole chunks')
+    parser.add_argument('--disable-opencl', action='store_const', const=False, dest='doOCL', default=None, help='disable OpenCL code')
+
+    args = parser.parse_args()
+
+    base = RegionConfig.load(args.name)
+    if not os.path.exists(base.mapfile):
+        raise IOError('no map file exists')
+    for factor in args.factors:
+        print "Deriving region %s at scale %d..." % (args.name, base.scale * factor)
+        report = RunReport('deriveregion')
+        derived = derive(base, factor, wantCL=args.doOCL, report=report)
+        report.save(derived.reportfile('deriveregion'))
+        print "Region %s is ready for buildregion" % derived.name
+
+if __name__ == '__main__':
+    sys.exit(main())
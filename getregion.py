@@ -3,6 +3,7 @@
 import logging
 logging.basicConfig(level=logging.WARNING)
 from region import Region
+from runreport import RunReport
 import sys
 import argparse
 
@@ -61,11 +62,14 @@ def main():
         logging.getLogger('suds.client').setLevel(logging.DEBUG)
 
     # create the region
+    report = RunReport('getregion')
+    report.start('create')
     print "Creating new region %s..." % args.name
     myRegion = Region(name=args.name, xmax=args.xmax, xmin=args.xmin, ymax=args.ymax, ymin=args.ymin, scale=args.scale, vscale=args.vscale, trim=args.trim, tilesize=args.tilesize, sealevel=args.sealevel, maxdepth=args.maxdepth, lcIDs=args.landcoverIDs, elIDs=args.elevationIDs, doOre=args.doOre, doSchematics=args.doSchematics)
 
     print "Retrieving files..."
-    myRegion.getfiles()
+    myRegion.getfiles(report)
+    report.save(myRegion.reportfile('getregion'))
 
 if __name__ == '__main__':
     sys.exit(main())
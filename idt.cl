@@ -3,7 +3,7 @@
 #define STACK_SIZE 30
 #define MAXBINS 256
 
-__kernel void idt(__global int *retvals, __global int *values, __global uint *tree, __global float2 *coords, const uint lentree, __global float2 *base, const uint lenbase, const uint ink, const uint usemajority) {
+__kernel void idt(__global int *retvals, __global int *values, __global uint *tree, __global float2 *coords, const uint lentree, __global float2 *base, const uint lenbase, const uint ink, const uint usemajority, const float eps) {
   // retvals -- OUTPUT: int array of shape (nelems)
   //            containing values for map
   // values -- INPUT: int array of shape (lentree)
@@ -19,6 +19,8 @@ __kernel void idt(__global int *retvals, __global int *values, __global uint *tr
   // lenbase -- INPUT: uint containing length of query points
   // ink -- INPUT: uint containing the number of neighbors to collect
   // usemajority -- INPUT: uint for either majority (1) or idw (0)
+  // eps -- INPUT: float, neighbors may be up to (1+eps) times farther
+  //        than the true ones
 
   uint gid = get_global_id(0);
   uint gsize = get_global_size(0);
@@ -35,6 +37,8 @@ __kernel void idt(__global int *retvals, __global int *values, __global uint *tr
   uint maxHeap, ktoobig = ink > MAX_K;
   maxHeap = select(ktoobig, ink, MAX_K);
   int retval = 0;
+  // pruning distances are scaled for approximate search
+  float epsfac = (1.0f + eps) * (1.0f + eps);
 
   for (uint idx = gid; idx < lenbase; idx += gsize) {
     float2 queryPoint = base[idx];
@@ -44,6 +48,7 @@ __kernel void idt(__global int *retvals, __global int *values, __global uint *tr
     float bestDist2 = MAXFLOAT;
     uint stackTop = 0;
     float queryValue, splitValue, diff, diff2;
+    int exactID = -1;
     
     // put root node on top of stack
     searchStackNode[stackTop] = 1;
@@ -72,7 +77,7 @@ __kernel void idt(__global int *retvals, __global int *values, __global uint *tr
           queryValue = queryVals[prevAxis];
           diff = queryValue - currSplit;
           diff2 = diff*diff;
-          if (diff2 >= dist2Heap) {
+          if (diff2 * epsfac >= dist2Heap) {
 	    // early exit approved
             continue;
           }
@@ -95,6 +100,12 @@ __kernel void idt(__global int *retvals, __global int *values, __global uint *tr
       float dy = currCoords.y - queryPoint.y;
       float diffDist2 = (dx*dx)+(dy*dy);
 
+      // an exact hit decides the value, stop searching
+      if (diffDist2 < 0.01f) {
+        exactID = currIdx;
+        break;
+      }
+
       // should we add this point to the heap?
       if (countHeap < maxHeap) {
         countHeap++;
@@ -177,7 +188,7 @@ __kernel void idt(__global int *retvals, __global int *values, __global uint *tr
 	bestDist2 = dist2Heap;
       }
       if (queryValue <= splitValue) {
-	if (diff2 < bestDist2) {
+	if (diff2 * epsfac < bestDist2) {
 	  if (rightIdx < lentree) {
 	    searchStackNode[stackTop] = rightIdx;
 	    searchStackAxis[stackTop] = nextAxis;
@@ -196,7 +207,7 @@ __kernel void idt(__global int *retvals, __global int *values, __global uint *tr
 	  stackTop++;
 	}
       } else {
-	if (diff2 < bestDist2) {
+	if (diff2 * epsfac < bestDist2) {
 	  if (leftIdx < lentree) {
 	    searchStackNode[stackTop] = leftIdx;
 	    searchStackAxis[stackTop] = nextAxis;
@@ -218,7 +229,9 @@ __kernel void idt(__global int *retvals, __global int *values, __global uint *tr
     } // while stacktop
     
     // final processing knnHeapID Dist
-    if (usemajority == 1) {
+    if (exactID >= 0) {
+      retval = values[tree[exactID]];
+    } else if (usemajority == 1) {
       // majority algorithm
       float bins[MAXBINS];
       int bin;
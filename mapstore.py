@@ -0,0 +1,42 @@
+# map store module
+import os
+import numpy as np
+from memoize import memoize
+from osgeo import gdal
+from osgeo.gdalconst import GA_ReadOnly
+from regionconfig import RegionConfig
+
+
+def storefile(mapfile):
+    """Returns the name of the raw array store for a map file."""
+    return '%s.npy' % os.path.splitext(mapfile)[0]
+
+
+def buildstore(mapfile):
+    """Decodes every band of the map into a raw array store unless an up to date one exists."""
+    filename = storefile(mapfile)
+    if os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(mapfile):
+        return filename
+    mapds = gdal.Open(mapfile, GA_ReadOnly)
+    # bands are decoded one at a time straight into the store
+    tmpname = '%s.tmp.npy' % os.path.splitext(mapfile)[0]
+    store = np.lib.format.open_memmap(tmpname, mode='w+', dtype=np.int16, shape=(len(RegionConfig.rasters), mapds.RasterYSize, mapds.RasterXSize))
+    for band in RegionConfig.rasters.values():
+        store[band-1] = mapds.GetRasterBand(band).ReadAsArray()
+    store.flush()
+    store = None
+    mapds = None
+    os.rename(tmpname, filename)
+    return filename
+
+
+@memoize()
+def openstore(filename):
+    """Returns a read-only memory map of a raw array store, shared by every tile in this process."""
+    return np.load(filename, mmap_mode='r')
+
+
+def readwindow(filename, ox, oy, sx, sy):
+    """Returns views of the landcover, elevation, bathy and crust arrays in a window of the store."""
+    store = openstore(filename)
+    return tuple([store[RegionConfig.rasters[name]-1, oy:oy+sy, ox:ox+sx] for name in ['landcover', 'elevation', 'bathy', 'crust']])
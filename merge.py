@@ -0,0 +1,68 @@
+# merge module
+import os
+import shutil
+from utils import cleanmkdir
+from worldsave import saveregions
+from phasetimer import PhaseTimer
+from pymclevel import mclevel, box
+
+# Anvil region files hold 32x32 chunks of 16x16 columns each
+regionWidth = 32 * 16
+
+
+def tileextents(tilex, tiley, size):
+    """Returns the Minecraft extents (xmin, xmax, zmin, zmax) of a tile."""
+    return (tilex * size, (tilex + 1) * size, tiley * size, (tiley + 1) * size)
+
+
+def shardtiles(tiles, size):
+    """Returns a dict mapping destination region files to the tiles that overlap them."""
+    shards = dict()
+    for (name, tilex, tiley) in tiles:
+        (xmin, xmax, zmin, zmax) = tileextents(tilex, tiley, size)
+        for rx in xrange(xmin // regionWidth, (xmax - 1) // regionWidth + 1):
+            for rz in xrange(zmin // regionWidth, (zmax - 1) // regionWidth + 1):
+                shards.setdefault((rx, rz), []).append((tilex, tiley))
+    return shards
+
+
+def shardchunks(chunks, rx, rz):
+    """Returns the chunks from an inventory which belong to the given region file."""
+    return [(cx, cz) for (cx, cz) in chunks if cx >> 5 == rx and cz >> 5 == rz]
+
+
+def mergeshard(args):
+    """Builds a single destination region file from the tiles that overlap it."""
+    # tiles is a list of (tilex, tiley, chunks) where chunks is the
+    # part of the tile's chunk inventory which lies in this shard
+    (name, rx, rz, tiles) = args
+    regionfile = 'r.%d.%d.mca' % (rx, rz)
+    timer = PhaseTimer()
+
+    # each shard is assembled in its own scratch world
+    timer.start('copy')
+    sharddir = cleanmkdir(os.path.join('regions', name, 'Shards', 'r.%d.%d' % (rx, rz)))
+    world = mclevel.MCInfdevOldLevel(sharddir, create=True)
+    for (tilex, tiley, chunks) in tiles:
+        if not chunks:
+            continue
+        xmin = min([cx for (cx, cz) in chunks]) * 16
+        xmax = (max([cx for (cx, cz) in chunks]) + 1) * 16
+        zmin = min([cz for (cx, cz) in chunks]) * 16
+        zmax = (max([cz for (cx, cz) in chunks]) + 1) * 16
+        copybox = box.BoundingBox((xmin, 0, zmin), (xmax - xmin, world.Height, zmax - zmin))
+        world.createChunksInBox(copybox)
+        tiledir = os.path.join('regions', name, 'Tiles', '%dx%d' % (tilex, tiley))
+        tileworld = mclevel.MCInfdevOldLevel(tiledir, create=False)
+        world.copyBlocksFrom(tileworld, copybox, copybox.origin)
+        tileworld = False
+    timer.start('save')
+    saveregions(world)
+    world.saveInPlace()
+    world = False
+
+    # the scratch world holds exactly one region file, move it into place
+    worldregiondir = os.path.join('worlds', name, 'region')
+    os.rename(os.path.join(sharddir, 'region', regionfile), os.path.join(worldregiondir, regionfile))
+    shutil.rmtree(sharddir)
+    return {'rx': rx, 'rz': rz, 'timings': timer.result()}
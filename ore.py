@@ -23,14 +23,15 @@ class Ore(object):
         self.depth = depth
         self.rounds = rounds
         self.size = size
+        # stamps are ellipsoid offsets keyed by the radius-like values
+        self.stamps = dict()
 
-    def __call__(self, coords):
-        # generate ellipsoid values based on parameters
-        (mcx, mcy, mcz) = coords
-        # start with random radius-like values
-        x0 = randint(1, 4)
-        y0 = randint(1, 4)
-        z0 = randint(1, 4)
+    def stamp(self, x0, y0, z0):
+        """Returns the offsets of the ellipsoid for the given radius-like values."""
+        try:
+            return self.stamps[(x0, y0, z0)]
+        except KeyError:
+            pass
         v0 = 4/3 * pi * x0 * y0 * z0
         # scale to match volume and round up
         scale = cbrt(self.size / v0)
@@ -46,7 +47,22 @@ class Ore(object):
         yr = xrange(-1 * y1, y1)
         zr = xrange(-1 * z1, z1)
         # calculate ellipsoid
-        oreCoords = [[mcx+x, mcy+y, mcz+z] for x, y, z in product(xr, yr, zr) if x*x/x2+y*y/y2+z*z/z2 <= 1]
+        self.stamps[(x0, y0, z0)] = [(x, y, z) for x, y, z in product(xr, yr, zr) if x*x/x2+y*y/y2+z*z/z2 <= 1]
+        return self.stamps[(x0, y0, z0)]
+
+    def compile(self):
+        """Builds the stamps for every radius-like value."""
+        for x0, y0, z0 in product(xrange(1, 5), xrange(1, 5), xrange(1, 5)):
+            self.stamp(x0, y0, z0)
+
+    def __call__(self, coords):
+        # generate ellipsoid values based on parameters
+        (mcx, mcy, mcz) = coords
+        # start with random radius-like values
+        x0 = randint(1, 4)
+        y0 = randint(1, 4)
+        z0 = randint(1, 4)
+        oreCoords = [[mcx+x, mcy+y, mcz+z] for x, y, z in self.stamp(x0, y0, z0)]
         # if len(oreCoords) > self.size+2:
         #     print "warning: oreCoords larger than self.size -- %d > %d" % (len(oreCoords), self.size)
         # if len(oreCoords) < self.size-2:
@@ -55,9 +71,11 @@ class Ore(object):
 
     @staticmethod
     def placeoreintile(tile):
+        """Deposits ore in a tile or defers it to the region, returns the number of blocks placed."""
         # strictly speaking, this should be in class Tile somehow
         oreobjs = dict([(ore.name, ore) for ore in oreObjs])
         tile.ores = dict([(name, list()) for name in oreobjs])
+        placed = 0
 
         for ore in oreobjs:
             extent = cbrt(oreobjs[ore].size)*2
@@ -79,6 +97,8 @@ class Ore(object):
                     for x, y, z in oreobjs[ore](coords):
                         if tile.world.blockAt(x, y, z) == Ore.stoneID:
                             tile.world.setBlockAt(x, y, z, oreID)
+                            placed += 1
+        return placed
 
     @staticmethod
     def placeoreinregion(ores, oreobjs, world):
@@ -0,0 +1,67 @@
+# palette module
+import numpy as np
+from pymclevel.materials import alphaMaterials
+
+
+def blockids():
+    """Returns block IDs keyed by block name, first match wins."""
+    ids = dict()
+    for block in alphaMaterials.allBlocks:
+        ids.setdefault(block.name, block.ID)
+    return ids
+
+
+class Palette(object):
+    """
+    Registry of block IDs built once at import.
+
+    Blocks are named as in the terrain definitions: a block name,
+    a (name, data) pair or an (ID, data) pair from a schematic.
+    Each one resolves to an (ID, data) pair of small integers.
+
+    """
+
+    ids = blockids()
+
+    # resolved blocks keyed by how they were named
+    blocks = dict()
+
+    @staticmethod
+    def resolve(block):
+        """Returns the (ID, data) pair for a named block."""
+        try:
+            return Palette.blocks[block]
+        except KeyError:
+            pass
+        if isinstance(block, basestring):
+            resolved = (Palette.ids[block], 0)
+        elif isinstance(block[0], basestring):
+            resolved = (Palette.ids[block[0]], block[1])
+        else:
+            resolved = (int(block[0]), int(block[1]))
+        Palette.blocks[block] = resolved
+        return resolved
+
+    @staticmethod
+    def column(layers):
+        """Resolves the blocks of a list of (depth, block) layers."""
+        return [(depth, Palette.resolve(block)) for (depth, block) in layers]
+
+    @staticmethod
+    def lookup(blocks):
+        """Returns ID and data arrays for a list of named blocks."""
+        resolved = [Palette.resolve(block) for block in blocks]
+        return (np.array([blockid for (blockid, data) in resolved], dtype=np.int32),
+                np.array([data for (blockid, data) in resolved], dtype=np.int32))
+
+    @staticmethod
+    def table(mapping, default='Air', size=256):
+        """Returns ID and data arrays indexed by code for a dict of codes to named blocks."""
+        (blockid, data) = Palette.resolve(default)
+        blocktable = np.empty(size, dtype=np.int32)
+        blocktable.fill(blockid)
+        datatable = np.empty(size, dtype=np.int32)
+        datatable.fill(data)
+        for code in mapping:
+            (blocktable[code], datatable[code]) = Palette.resolve(mapping[code])
+        return (blocktable, datatable)
@@ -0,0 +1,69 @@
+# phase timer module
+import os
+import resource
+from time import time
+
+
+class PhaseTimer(object):
+    """
+    Records wall and CPU time for the named phases of a job.
+
+    The peak resident set size is the high-water mark of the whole
+    process, which in a pool worker covers every job it has run, so
+    each job also records how far it raised that mark.
+
+    """
+
+    def __init__(self):
+        self.order = []
+        self.wall = dict()
+        self.cpu = dict()
+        self.counts = dict()
+        self.rss = dict()
+        self.current = None
+        self.startrss = PhaseTimer.peakrss()
+
+    @staticmethod
+    def cputime():
+        """Returns user plus system time for this process."""
+        times = os.times()
+        return times[0] + times[1]
+
+    @staticmethod
+    def peakrss():
+        """Returns the peak resident set size of this process in kilobytes."""
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def start(self, name):
+        """Starts a phase, stopping the current one.  Phases may be repeated."""
+        self.stop()
+        if name not in self.order:
+            self.order.append(name)
+            self.wall[name] = 0.0
+            self.cpu[name] = 0.0
+        self.current = (name, time(), PhaseTimer.cputime())
+
+    def stop(self):
+        """Stops the current phase."""
+        if self.current is None:
+            return
+        (name, wallstart, cpustart) = self.current
+        self.wall[name] += time() - wallstart
+        self.cpu[name] += PhaseTimer.cputime() - cpustart
+        self.rss[name] = PhaseTimer.peakrss() - self.startrss
+        self.current = None
+
+    def count(self, name, value):
+        """Adds to a named counter such as the number of blocks written."""
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def result(self):
+        """Returns the recorded values as plain data."""
+        self.stop()
+        return {'phases': list(self.order),
+                'wall': dict(self.wall),
+                'cpu': dict(self.cpu),
+                'counts': dict(self.counts),
+                'phaserssgrowth': dict(self.rss),
+                'peakrss': PhaseTimer.peakrss(),
+                'peakrssgrowth': PhaseTimer.peakrss() - self.startrss}
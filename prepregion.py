@@ -6,23 +6,34 @@ import sys
 import argparse
 import os
 import yaml
+from runreport import RunReport
 
 
 def main():
     """Rebuilds maps on broken regions."""
     parser = argparse.ArgumentParser(description='Prepares downloaded regions for building.')
     parser.add_argument('--name', required=True, type=str, help='name of region')
-    parser.add_argument('--disable-opencl', action='store_false', dest='doOCL', default=True, help='disable OpenCL code')
-    parser.add_argument('--pickle', action='store_true', dest='doPickle', help='pickle variables for test purposes')
+    parser.add_argument('--disable-opencl', action='store_const', const=False, dest='doOCL', default=None, help='disable OpenCL code')
+    parser.add_argument('--force-opencl', action='store_const', const=True, dest='doOCL', help='use OpenCL code for every stage')
+    parser.add_argument('--landcover-nnear', type=int, help='neighbors checked when interpolating landcover (default 11)')
+    parser.add_argument('--landcover-eps', default=0.0, type=float, help='approximation allowed when interpolating landcover (default 0)')
+    parser.add_argument('--crust-nnear', type=int, help='neighbors checked when interpolating crust (default 11)')
+    parser.add_argument('--crust-eps', default=0.0, type=float, help='approximation allowed when interpolating crust (default 0)')
+    parser.add_argument('--capture', action='store_true', dest='doCapture', help='capture stage inputs for replay')
 
     args = parser.parse_args()
 
     print "Preparing region %s..." % args.name
+    report = RunReport('prepregion')
+    report.start('load')
     yamlfile = file(os.path.join('regions', args.name, 'Region.yaml'))
     myRegion = yaml.load(yamlfile)
     yamlfile.close()
 
-    myRegion.build_map(args.doOCL, args.doPickle)
+    idtknobs = {'landcover': {'nnear': args.landcover_nnear, 'eps': args.landcover_eps},
+                'crust': {'nnear': args.crust_nnear, 'eps': args.crust_eps}}
+    myRegion.build_map(args.doOCL, args.doCapture, report, idtknobs)
+    report.save(myRegion.reportfile('prepregion'))
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -2,12 +2,11 @@
 
 from __future__ import division
 from math import ceil, floor
-import suds
 import re
 import os
+import hashlib
 import urllib2
 import urlparse
-from progressbar import ProgressBar, Percentage, Bar, ETA, FileTransferSpeed
 import yaml
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -17,12 +16,10 @@ from pymclevel import mclevel
 
 from osgeo import gdal, osr, ogr
 from osgeo.gdalconst import GDT_Int16, GA_ReadOnly
-from bathy import Bathy
-from crust import Crust
 import numpy as np
-#
-from idt import IDT
-from elev import Elev
+from tilestats import TileStats
+from runreport import RunReport
+from regionconfig import RegionConfig
 
 
 class SmartRedirectHandler(urllib2.HTTPRedirectHandler):
@@ -45,7 +42,7 @@ class Region:
     albers = "+proj=aea +datum=NAD83 +lat_1=29.5 +lat_2=45.5 +lat_0=23 +lon_0=-96 +x_0=0 +y_0=0 +units=m"
 
     # raster layer order
-    rasters = {'landcover': 1, 'elevation': 2, 'bathy': 3, 'crust': 4}
+    rasters = RegionConfig.rasters
 
     # sadness
     gdalwarp_broken_for_landcover = True
@@ -66,6 +63,11 @@ class Region:
     # download directory
     downloadtop = os.path.abspath('downloads')
     regiontop = os.path.abspath('regions')
+    # source tiles reprojected to Albers, shared by every region
+    warptop = os.path.join(downloadtop, 'warped')
+    # elevation nodata when the source does not say, and the length of a degree of latitude
+    elnodata = -340282346638529993179660072199368212480.0
+    metersperdegree = 111320
 
     # properties
     @property
@@ -84,6 +86,28 @@ class Region:
     def mapfile(self):
         return os.path.join(self.regiondir, 'Map.tif')
 
+    @property
+    def borderfile(self):
+        return os.path.join(self.regiondir, 'Border.tif')
+
+    @property
+    def tilestatsfile(self):
+        return os.path.join(self.regiondir, 'TileStats.yaml')
+
+    def reportfile(self, stage):
+        return os.path.join(self.regiondir, '%s.json' % stage)
+
+    def mosaicfile(self, layerID):
+        return os.path.join(self.mapsdir, '%s-albers.vrt' % layerID)
+
+    def layerfile(self, layerID):
+        """Returns the Albers dataset for a layer, a mosaic of cached tiles if one was built."""
+        # older regions have a <layerID>.vrt of unprojected tiles and a warped <layerID>.tif
+        mosaicfile = self.mosaicfile(layerID)
+        if os.path.exists(mosaicfile):
+            return mosaicfile
+        return os.path.join(self.mapsdir, '%s.tif' % layerID)
+
     # product types in order of preference
     productIDs = {'elevation': ['N3F', 'N2F', 'N1F'],
                   'landcover': sorted(Terrain.translate.keys())}
@@ -91,7 +115,7 @@ class Region:
     # FIXME: check N2F value
     exsuf = {'N3F': '13', 'N2F': '12', 'N1F': '1'}
 
-    def __init__(self, name, xmax, xmin, ymax, ymin, tilesize=None, scale=None, vscale=None, trim=None, sealevel=None, maxdepth=None, lcIDs=None, elIDs=None, doOre=True, doSchematics=False):
+    def __init__(self, name, xmax, xmin, ymax, ymin, tilesize=None, scale=None, vscale=None, trim=None, sealevel=None, maxdepth=None, lcIDs=None, elIDs=None, doOre=True, doSchematics=False, offline=False):
         """Create a region based on lat-longs and other parameters."""
         # NB: smart people check names
         self.name = name
@@ -197,13 +221,19 @@ class Region:
             self.wgs84extents[maptype] = {'xmax': wxmax, 'xmin': wxmin, 'ymax': wymax, 'ymin': wymin}
 
         # check availability of product IDs and identify specific layer IDs
-        self.lclayer = self.check_availability(landcoverIDs, 'landcover')
-        self.ellayer = self.check_availability(elevationIDs, 'elevation')
+        # offline regions take the first IDs and supply their own datasets
+        if offline:
+            self.lclayer = landcoverIDs[0]
+            self.ellayer = elevationIDs[0]
+        else:
+            self.lclayer = self.check_availability(landcoverIDs, 'landcover')
+            self.ellayer = self.check_availability(elevationIDs, 'elevation')
 
         # write the values to the file
         stream = file(os.path.join(self.regionfile), 'w')
         yaml.dump(self, stream)
         stream.close()
+        RegionConfig.fromregion(self).save()
 
     def layertype(self, layerID):
         """Return 'elevation' or 'landcover' depending on layerID."""
@@ -236,6 +266,7 @@ class Region:
         mapextents = self.wgs84extents[maptype]
 
         # access the web service to check availability
+        import suds.client
         wsdlInv = "http://ags.cr.usgs.gov/index_service/Index_Service_SOAP.asmx?WSDL"
         clientInv = suds.client.Client(wsdlInv)
 
@@ -274,6 +305,7 @@ class Region:
         retval = {}
 
         # request validation
+        import suds.client
         wsdlRequest = "http://extract.cr.usgs.gov/requestValidationService/wsdl/RequestValidationService.wsdl"
         clientRequest = suds.client.Client(wsdlRequest)
 
@@ -302,8 +334,10 @@ class Region:
         justfile = os.path.split(longfile)[1]
         return justfile
 
-    def retrievefile(self, layerID, downloadURL):
+    def retrievefile(self, layerID, downloadURL, report=None):
         """Retrieve the datafile associated with the URL.  This may require downloading it from the USGS servers or extracting it from a local archive."""
+        if report is None:
+            report = RunReport('retrievefile')
         fname = Region.getfn(downloadURL)
         layerdir = os.path.join(Region.downloadtop, layerID)
         if not os.path.exists(layerdir):
@@ -332,8 +366,13 @@ class Region:
         webPage = opener.open(req)
         if maxSize == existSize:
             print "Using cached file for layerID %s" % layerID
+            report.count('cachehits', 1)
+            report.count('cachedbytes', maxSize)
         else:
+            report.count('downloads', 1)
+            report.count('resumedbytes', existSize)
             print "Downloading file from server for layerID %s" % layerID
+            from progressbar import ProgressBar, Percentage, Bar, ETA, FileTransferSpeed
             pbar = ProgressBar(widgets=[Percentage(), ' ', Bar(), ' ', ETA(), ' ', FileTransferSpeed()], maxval=maxSize).start()
             # This chunk size may be small!
             max_chunk_size = 8192
@@ -360,6 +399,7 @@ class Region:
                     break
                 outputFile.write(data)
                 numBytes = numBytes + len(data)
+                report.count('downloadedbytes', len(data))
             pbar.finish()
             webPage.close()
             outputFile.close()
@@ -373,40 +413,136 @@ class Region:
         for extractfile in extractfiles:
             if os.path.exists(os.path.join(layerdir, extractfile)):
                 print "Using existing file %s for layerID %s" % (extractfile, layerID)
+                report.count('extractcachehits', 1)
             else:
+                report.count('extracts', 1)
                 os.system('unzip "%s" "%s" -d "%s"' % (downloadfile, extractfile, layerdir))
         return os.path.join(layerdir, extractfiles[0])
 
-    def getfiles(self):
+    @staticmethod
+    def warpoptions(extractfile, nodata=None):
+        """Returns gdalwarp options putting every source tile of a product on one Albers grid."""
+        # tiles of a product share a pixel size, so they share a grid and
+        # the fill around each reprojected tile is nodata in the mosaic
+        ds = gdal.Open(extractfile, GA_ReadOnly)
+        pixelsize = abs(ds.GetGeoTransform()[5])
+        if osr.SpatialReference(ds.GetProjection()).IsGeographic():
+            pixelsize *= Region.metersperdegree
+        if nodata is None:
+            nodata = ds.GetRasterBand(1).GetNoDataValue()
+        if nodata is None:
+            nodata = Region.elnodata
+        ds = None
+        resolution = max(1, int(round(pixelsize)))
+        return '-t_srs "%s" -tr %d %d -tap -dstnodata "%s"' % (Region.albers, resolution, resolution, repr(float(nodata)))
+
+    @staticmethod
+    def warpedfile(layerID, extractfile, options):
+        """Returns the cache file for a source tile reprojected to Albers."""
+        stat = os.stat(extractfile)
+        key = '\0'.join([os.path.abspath(extractfile), str(stat.st_size), str(int(stat.st_mtime)), options])
+        digest = hashlib.sha1(key).hexdigest()[:16]
+        return os.path.join(Region.warptop, layerID, '%s-%s.tif' % (os.path.splitext(os.path.basename(extractfile))[0], digest))
+
+    @staticmethod
+    def warpfile(layerID, extractfile, nodata=None, report=None):
+        """Reprojects a source tile to Albers unless the cache already holds it."""
+        if report is None:
+            report = RunReport('warpfile')
+        options = Region.warpoptions(extractfile, nodata)
+        warpedfile = Region.warpedfile(layerID, extractfile, options)
+        if os.path.exists(warpedfile):
+            print "Using cached warp of %s" % os.path.basename(extractfile)
+            report.count('warpcachehits', 1)
+            return warpedfile
+        warpdir = os.path.dirname(warpedfile)
+        if not os.path.exists(warpdir):
+            os.makedirs(warpdir)
+        # regions sharing the cache may warp the same tile at once
+        tmpfile = '%s.tmp%d.tif' % (os.path.splitext(warpedfile)[0], os.getpid())
+        warpcmd = 'gdalwarp -q -multi %s "%s" "%s"' % (options, extractfile, tmpfile)
+        os.system('%s' % warpcmd)
+        os.rename(tmpfile, warpedfile)
+        report.count('warps', 1)
+        return warpedfile
+
+    def getfiles(self, report=None):
         """Get files from USGS and extract them if necessary."""
+        if report is None:
+            report = RunReport('getfiles')
         layerIDs = [self.lclayer, self.ellayer]
+        report.start('validation')
         downloadURLs = self.request_validation(layerIDs)
         for layerID in downloadURLs:
             extractlist = []
+            report.start('retrieve')
             for downloadURL in downloadURLs[layerID]:
-                extractfile = self.retrievefile(layerID, downloadURL)
+                extractfile = self.retrievefile(layerID, downloadURL, report)
                 extractlist.append(extractfile)
-            # Build VRTs
-            vrtfile = os.path.join(self.mapsdir, '%s.vrt' % layerID)
-            buildvrtcmd = 'gdalbuildvrt "%s" %s' % (vrtfile, ' '.join(['"%s"' % os.path.abspath(extractfile) for extractfile in extractlist]))
+            # Reproject each source tile once for all regions
+            # landcover 0 is unclassified, elevation keeps its source nodata
+            report.start('warp')
+            nodata = 0 if self.layertype(layerID) == 'landcover' else None
+            warpedlist = [Region.warpfile(layerID, extractfile, nodata, report) for extractfile in extractlist]
+            # Build VRTs of the reprojected tiles
+            report.start('vrt')
+            buildvrtcmd = 'gdalbuildvrt "%s" %s' % (self.mosaicfile(layerID), ' '.join(['"%s"' % warpedfile for warpedfile in warpedlist]))
             os.system('%s' % buildvrtcmd)
-            # Generate warped GeoTIFFs
-            tiffile = os.path.join(self.mapsdir, '%s.tif' % layerID)
-            warpcmd = 'gdalwarp -q -multi -t_srs "%s" "%s" "%s"' % (Region.albers, vrtfile, tiffile)
-            os.system('%s' % warpcmd)
+        report.stop()
+
+    def build_map(self, wantCL=None, do_capture=False, report=None, idtknobs=None):
+        """
+        Use downloaded files and other parameters to build multi-raster map.
+
+        If wantCL is None, each stage uses whichever backend this host's
+        calibration found faster for its size, or OpenCL without one.
+
+        idtknobs maps 'landcover' and 'crust' to the nnear and eps
+        values used by their inverse distance trees.
+
+        """
+        if report is None:
+            report = RunReport('build_map')
+        # the OpenCL stack is only needed here
+        from bathy import Bathy
+        from crust import Crust
+        from idt import IDT
+        from elev import Elev
+        from calibrate import Calibration
+
+        calibration = None
+        if wantCL is None:
+            calibration = Calibration.load()
+        report.data['backends'] = dict()
+        knobs = dict([(stage, {'nnear': None, 'eps': 0.0}) for stage in ['landcover', 'crust']])
+        if idtknobs is not None:
+            for stage in idtknobs:
+                knobs[stage].update(idtknobs[stage])
+        report.data['idtknobs'] = knobs
+
+        def stageCL(stage, elements):
+            if wantCL is not None:
+                choice = wantCL
+            elif calibration is None:
+                choice = True
+            else:
+                choice = calibration.wantCL(stage, elements)
+            return choice
 
-    def build_map(self, wantCL=True, do_pickle=False):
-        """Use downloaded files and other parameters to build multi-raster map."""
+        # engines fall back to the CPU when OpenCL cannot run them
+        def stageused(stage, engine):
+            report.data['backends'][stage] = 'opencl' if engine.usedCL else 'cpu'
 
-        # set pickle variable
-        if do_pickle:
-            pickle_name = self.name
+        # set capture variable
+        if do_capture:
+            capture_name = self.name
         else:
-            pickle_name = None
+            capture_name = None
 
         # warp elevation data into new format
+        report.start('warp')
         # NB: can't do this to landcover until mode algorithm is supported
-        eltif = os.path.join(self.mapsdir, '%s.tif' % self.ellayer)
+        eltif = self.layerfile(self.ellayer)
         elfile = os.path.join(self.mapsdir, '%s-new.tif' % self.ellayer)
         elextents = self.albersextents['elevation']
         warpcmd = 'gdalwarp -q -multi -tr %d %d -te %d %d %d %d -r cubic "%s" "%s" -srcnodata "-340282346638529993179660072199368212480.000" -dstnodata 0' % (self.scale, self.scale, elextents['xmin'], elextents['ymin'], elextents['xmax'], elextents['ymax'], eltif, elfile)
@@ -483,21 +619,31 @@ class Region:
         mapds.SetProjection(srs.ExportToWkt())
 
         # modify elarray and save it as raster band 2
-        elevObj = Elev(elarray, wantCL=wantCL)
-        actualel = elevObj(self.trim, self.vscale, self.sealevel, pickle_name=pickle_name)
+        report.start('elev')
+        elevObj = Elev(elarray, wantCL=stageCL('elev', elarray.size))
+        actualel = elevObj(self.trim, self.vscale, self.sealevel, capture_name=capture_name)
+        stageused('elev', elevObj)
+        report.start('write')
         mapds.GetRasterBand(Region.rasters['elevation']).WriteArray(actualel)
+        report.start('stats')
+        tilestats = TileStats(self.tiles, self.tilesize)
+        tilestats.addelevation(actualel)
         elarray = None
         actualel = None
 
         # generate crust and save it as raster band 4
-        newcrust = Crust(mapds.RasterXSize, mapds.RasterYSize, wantCL=wantCL)
-        crustarray = newcrust(pickle_name=pickle_name)
+        report.start('crust')
+        newcrust = Crust(mapds.RasterXSize, mapds.RasterYSize, wantCL=stageCL('crust', mapds.RasterXSize*mapds.RasterYSize))
+        crustarray = newcrust(nnear=knobs['crust']['nnear'], eps=knobs['crust']['eps'], capture_name=capture_name)
+        stageused('crust', newcrust.idt)
+        report.start('write')
         mapds.GetRasterBand(Region.rasters['crust']).WriteArray(crustarray)
         crustarray = None
         newcrust = None
 
         # read landcover array
-        lctif = os.path.join(self.mapsdir, '%s.tif' % self.lclayer)
+        report.start('landcover')
+        lctif = self.layerfile(self.lclayer)
         lcfile = os.path.join(self.mapsdir, '%s-new.tif' % self.lclayer)
         # here are the things that need to happen
         lcextents = self.albersextents['landcover']
@@ -534,10 +680,11 @@ class Region:
             depthyrange = [lcextents['ymax'] - self.scale * y for y in xrange(depthylen)]
             depthbase = np.array([(x, y) for y in depthyrange for x in depthxrange], dtype=np.float32)
             # 4. an inverse distance tree must be built from that
-            lcIDT = IDT(coords, values.ravel().astype(np.int32), wantCL=wantCL)
+            lcIDT = IDT(coords, values.ravel().astype(np.int32), wantCL=stageCL('idt', len(depthbase)))
             # 5. the desired output comes from that inverse distance tree
             depthshape = (depthylen, depthxlen)
-            deptharray = lcIDT(depthbase, depthshape, pickle_name=pickle_name)
+            deptharray = lcIDT(depthbase, depthshape, nnear=knobs['landcover']['nnear'], eps=knobs['landcover']['eps'], capture_name=capture_name)
+            stageused('idt', lcIDT)
             lcIDT = None
         else:
             warpcmd = 'gdalwarp -q -multi -tr %d %d -te %d %d %d %d -r near "%s" "%s"' % (self.scale, self.scale, lcextents['xmin'], lcextents['ymin'], lcextents['xmax'], lcextents['ymax'], lctif, lcfile)
@@ -555,10 +702,20 @@ class Region:
         lcarray = deptharray[self.maxdepth:-1*self.maxdepth, self.maxdepth:-1*self.maxdepth]
         geotrans = [lcextents['xmin'], self.scale, 0, lcextents['ymax'], 0, -1 * self.scale]
         projection = srs.ExportToWkt()
-        bathyObj = Bathy(deptharray, geotrans, projection, wantCL=wantCL)
-        bathyarray = bathyObj(self.maxdepth, pickle_name=pickle_name)
+        report.start('bathy')
+        bathyObj = Bathy(deptharray, geotrans, projection, wantCL=stageCL('bathy', deptharray.size))
+        bathyarray = bathyObj(self.maxdepth, capture_name=capture_name)
+        stageused('bathy', bathyObj)
+        report.start('write')
         mapds.GetRasterBand(Region.rasters['bathy']).WriteArray(bathyarray)
+        # the landcover bathy saw, border included, lets coarser regions be derived
+        borderds = driver.Create(self.borderfile, deptharray.shape[1], deptharray.shape[0], 1, GDT_Int16)
+        borderds.SetGeoTransform(geotrans)
+        borderds.SetProjection(projection)
+        borderds.GetRasterBand(1).WriteArray(deptharray)
+        borderds = None
         # perform terrain translation
+        report.start('landcover')
         # NB: figure out why this doesn't work up above
         lcpid = self.lclayer[:3]
         if lcpid in Terrain.translate:
@@ -566,9 +723,21 @@ class Region:
             for key in trans:
                 lcarray[lcarray == key] = trans[key]
             for value in np.unique(lcarray).flat:
-                if value not in Terrain.terdict:
+                if not Terrain.known(value):
                     print "bad value: ", value
+        report.start('write')
         mapds.GetRasterBand(Region.rasters['landcover']).WriteArray(lcarray)
+        report.start('stats')
+        tilestats.addlandcover(lcarray)
 
         # close the dataset
+        report.start('write')
         mapds = None
+
+        # save tile statistics for scheduling
+        report.start('stats')
+        tilestats.save(self.tilestatsfile)
+        report.stop()
+
+        # tile workers read the adjusted values from the config
+        RegionConfig.fromregion(self).save()
@@ -0,0 +1,76 @@
+# region config module
+import os
+import json
+
+
+class RegionConfig(object):
+    """Plain data copy of the region values needed to build tiles."""
+
+    # raster layer order
+    rasters = {'landcover': 1, 'elevation': 2, 'bathy': 3, 'crust': 4}
+
+    # region values copied into the config
+    keys = ['name', 'tilesize', 'scale', 'vscale', 'trim', 'sealevel', 'maxdepth', 'tiles', 'doOre', 'doSchematics']
+
+    regiontop = os.path.abspath('regions')
+
+    def __init__(self, **values):
+        for key in RegionConfig.keys:
+            setattr(self, key, values[key])
+
+    # properties
+    @property
+    def regiondir(self):
+        return os.path.join(RegionConfig.regiontop, self.name)
+
+    @property
+    def configfile(self):
+        return RegionConfig.filename(self.name)
+
+    @property
+    def mapfile(self):
+        return os.path.join(self.regiondir, 'Map.tif')
+
+    @property
+    def borderfile(self):
+        return os.path.join(self.regiondir, 'Border.tif')
+
+    @property
+    def tilestatsfile(self):
+        return os.path.join(self.regiondir, 'TileStats.yaml')
+
+    def reportfile(self, stage):
+        return os.path.join(self.regiondir, '%s.json' % stage)
+
+    @staticmethod
+    def filename(name):
+        return os.path.join(RegionConfig.regiontop, name, 'Config.json')
+
+    @staticmethod
+    def fromregion(region):
+        """Returns the config for a region object."""
+        return RegionConfig(**dict([(key, getattr(region, key)) for key in RegionConfig.keys]))
+
+    def save(self):
+        stream = file(self.configfile, 'w')
+        json.dump(dict([(key, getattr(self, key)) for key in RegionConfig.keys]), stream, indent=2, sort_keys=True)
+        stream.close()
+
+    @staticmethod
+    def load(name):
+        """Loads the config for the named region, writing it first for regions which predate it."""
+        filename = RegionConfig.filename(name)
+        if not os.path.exists(filename):
+            # unpickling the region imports the whole download stack
+            import yaml
+            yamlfile = file(os.path.join(RegionConfig.regiontop, name, 'Region.yaml'))
+            region = yaml.load(yamlfile)
+            yamlfile.close()
+            RegionConfig.fromregion(region).save()
+        stream = file(filename)
+        values = json.load(stream)
+        stream.close()
+        # json returns unicode strings
+        values['name'] = str(values['name'])
+        values['tiles'] = dict([(str(key), value) for key, value in values['tiles'].items()])
+        return RegionConfig(**dict([(str(key), value) for key, value in values.items()]))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import logging
+logging.basicConfig(level=logging.WARNING)
+import sys
+import os
+import glob
+import argparse
+from time import time
+import capture
+
+
+def stageclass(stage):
+    """Returns the class implementing a captured stage."""
+    if stage == 'elev':
+        from elev import Elev
+        return Elev
+    if stage == 'idt':
+        from idt import IDT
+        return IDT
+    if stage == 'bathy':
+        from bathy import Bathy
+        return Bathy
+    raise AttributeError('unknown stage %s' % stage)
+
+
+def replaycapture(dirname, backends, image=False):
+    """Runs a captured stage on each backend, comparing each result with the first."""
+    (stage, arrays, params) = capture.load(dirname)
+    engine = stageclass(stage)
+    timings = dict()
+    reference = None
+    for backend in backends:
+        print 'Generating results with %s' % backend
+        starttime = time()
+        results = engine.replay(arrays, params, wantCL=(backend == 'opencl'))
+        timings[backend] = time() - starttime
+        print '... finished in ', timings[backend], 'seconds!'
+        if reference is None:
+            reference = results
+        elif image:
+            imagefile = os.path.join(dirname, 'diff-%s-%s.png' % (backends[0], backend))
+            print 'Generating image of differences in %s' % imagefile
+            capture.diffimage(reference, results, imagefile)
+        else:
+            capture.compare(reference, results, engine.allowed_error_percentage)
+    return timings
+
+
+def sweepcapture(dirname, backends, nnears, epses):
+    """Reports the time and mismatches of each nnear and eps setting against the captured setting."""
+    (stage, arrays, params) = capture.load(dirname)
+    engine = stageclass(stage)
+    if stage != 'idt':
+        print 'Nothing to sweep for %s' % stage
+        return []
+    print 'Generating reference results with %s, nnear %d, eps %g' % (backends[0], params['nnear'], params.get('eps', 0.0))
+    reference = engine.replay(arrays, params, wantCL=(backends[0] == 'opencl'))
+    rows = []
+    print '%-8s %6s %8s %10s %10s' % ('backend', 'nnear', 'eps', 'seconds', 'mismatch')
+    for backend in backends:
+        for nnear in nnears:
+            for eps in epses:
+                setting = dict(params)
+                setting.update({'nnear': nnear, 'eps': eps})
+                starttime = time()
+                results = engine.replay(arrays, setting, wantCL=(backend == 'opencl'))
+                elapsed = time() - starttime
+                nomatch = capture.compare(reference, results, 100, verbose=False)
+                percentage = 100.0 * nomatch / max(reference.size, 1)
+                print '%-8s %6d %8g %10.3f %9.3f%%' % (backend, nnear, eps, elapsed, percentage)
+                rows.append((backend, nnear, eps, elapsed, percentage))
+    return rows
+
+
+def main(stage=None):
+    """Replays captured stage inputs."""
+    parser = argparse.ArgumentParser(description='Replays captured stages with OpenCL and CPU backends.')
+    parser.add_argument('captures', type=str, nargs='*', help='capture directories to replay')
+    parser.add_argument('--backends', nargs='+', choices=['opencl', 'cpu'], default=['cpu', 'opencl'], help='backends to run, the first is the reference')
+    parser.add_argument('--image', action='store_true', help='generate an image with the differences')
+    parser.add_argument('--nnear', nargs='+', type=int, help='sweep IDT captures over these neighbor counts')
+    parser.add_argument('--eps', nargs='+', type=float, help='sweep IDT captures over these approximations')
+
+    args = parser.parse_args()
+    if args.captures == []:
+        pattern = '%s-*' % stage if stage is not None else '*'
+        args.captures = sorted(glob.glob(capture.capturepath(pattern)))
+    for dirname in args.captures:
+        print 'Testing %s' % dirname
+        if args.nnear is not None or args.eps is not None:
+            (stage, arrays, params) = capture.load(dirname)
+            nnears = args.nnear if args.nnear is not None else [params.get('nnear', 11)]
+            epses = args.eps if args.eps is not None else [params.get('eps', 0.0)]
+            sweepcapture(dirname, args.backends, nnears, epses)
+        else:
+            replaycapture(dirname, args.backends, image=args.image)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+# run report module
+import json
+import resource
+import socket
+from time import time
+from phasetimer import PhaseTimer
+
+
+class RunReport(PhaseTimer):
+    """
+    Structured report for one run of a pipeline stage.
+
+    Phases are timed as with PhaseTimer, and any other values
+    worth tracking across releases are kept in data.
+
+    """
+
+    def __init__(self, stage):
+        PhaseTimer.__init__(self)
+        self.stage = stage
+        self.started = time()
+        self.data = dict()
+
+    def save(self, filename):
+        """Writes the report as JSON."""
+        report = {'stage': self.stage,
+                  'host': socket.gethostname(),
+                  'started': self.started,
+                  'elapsed': time() - self.started}
+        report.update(self.result())
+        # external tools such as gdalwarp run as child processes
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report['children'] = {'cpu': children.ru_utime + children.ru_stime, 'peakrss': children.ru_maxrss}
+        report.update(self.data)
+        stream = file(filename, 'w')
+        json.dump(report, stream, indent=2, sort_keys=True)
+        stream.close()
+        print "Run report saved to %s" % filename
@@ -1,6 +1,9 @@
 # schematic module
 from utils import height
 import os
+import hashlib
+import numpy as np
+from palette import Palette
 from pymclevel import mclevel
 
 
@@ -20,10 +23,19 @@ class Schematic(object):
     # value: schematic object
     schems = dict()
 
+    # dict
+    # key: landcover value
+    # value: (name, nameoffset, layout, offset), see Terrain.schematics
+    definitions = dict()
+
+    # parsed schematic files
+    cachedir = os.path.abspath(os.path.join('cache', 'schematics'))
+
     def __init__(self, tag=None, layout=None, offset=1):
         # handles:
         # - file-based (tag=foo, layout=None)
         # - layout-based (tag=None, layout=[[[(1, 'Stone')]]])
+        # blocks and datas are indexed [x, z, y]
         if tag is None and layout is None:
             raise AttributeError('tag or layout must be specified')
         if layout is None:
@@ -31,60 +43,77 @@ class Schematic(object):
             if not os.path.exists(filename):
                 raise IOError('no file found')
             else:
-                schem = mclevel.fromFile(filename)
-                self.layout = [[Schematic.compressrow([(1, (int(schem.Blocks[elemX, elemZ, elemY]), int(schem.Data[elemX, elemZ, elemY]))) for elemY in xrange(schem.Height)]) for elemZ in xrange(schem.Length)] for elemX in xrange(schem.Width)]
+                (self.blocks, self.datas) = Schematic.readfile(filename)
         else:
-            self.layout = layout
+            (self.blocks, self.datas) = Schematic.expand(layout)
         self.offset = offset
-        self.width = len(self.layout)
-        self.length = len(self.layout[0])
-        self.height = height(self.layout[0][0])
+        (self.width, self.length, self.height) = self.blocks.shape
 
     @staticmethod
-    def compressrow(yrow):
-        """Compresses duplicate values in rows."""
-        retval = []
-        for elem in yrow:
-            if retval and retval[-1][1] == elem[1]:
-                retval[-1] = ((retval[-1][0] + elem[0]), elem[1])
-            else:
-                retval.append(elem)
-        return retval
+    def expand(layout):
+        """Returns block and data arrays for a layout of columns of (depth, block) layers."""
+        length = len(layout[0])
+        columnheight = height(layout[0][0])
+        blocks = np.zeros((len(layout), length, columnheight), dtype=np.int32)
+        datas = np.zeros((len(layout), length, columnheight), dtype=np.int32)
+        for x, row in enumerate(layout):
+            if len(row) != length:
+                raise AttributeError('not all rows are the same width')
+            for z, col in enumerate(row):
+                if height(col) != columnheight:
+                    raise AttributeError('not all cols are the same height')
+                base = 0
+                for (depth, (block, data)) in Palette.column(col):
+                    blocks[x, z, base:base+depth] = block
+                    datas[x, z, base:base+depth] = data
+                    base += depth
+        return (blocks, datas)
 
-    def check(self, verbose=False):
-        if not all([len(row) == self.length for row in self.layout]):
-            raise AttributeError('not all rows are the same width')
-
-        if not all([height(col) == self.height for row in self.layout for col in row]):
-            raise AttributeError('not all cols are the same height')
+    @staticmethod
+    def readfile(filename):
+        """Returns block and data arrays for a schematic file, parsing it only when it has changed."""
+        stream = file(filename, 'rb')
+        digest = hashlib.sha1(stream.read()).hexdigest()
+        stream.close()
+        cachefile = os.path.join(Schematic.cachedir, '%s.npz' % os.path.splitext(os.path.basename(filename))[0])
+        if os.path.exists(cachefile):
+            cache = np.load(cachefile)
+            try:
+                if str(cache['digest']) == digest:
+                    return (cache['blocks'], cache['datas'])
+            finally:
+                cache.close()
+        schem = mclevel.fromFile(filename)
+        blocks = np.array(schem.Blocks, dtype=np.int32)
+        datas = np.array(schem.Data, dtype=np.int32)
+        if not os.path.exists(Schematic.cachedir):
+            os.makedirs(Schematic.cachedir)
+        np.savez(cachefile, digest=digest, blocks=blocks, datas=datas)
+        return (blocks, datas)
 
-        if verbose:
-            print "schematic has dimensions %dX x %dY x %dZ" % (self.length, self.height, self.width)
+    def stamp(self, xs, zs):
+        """Returns the block and data columns at Minecraft coordinates, repeating the schematic."""
+        return (self.blocks[xs % self.width, zs % self.length], self.datas[xs % self.width, zs % self.length])
 
     @staticmethod
-    def use(key, name, nameoffset, layout, offset):
-        def decorator(target):
-            def wrapper(*args, **kwargs):
-                # major assumption:
-                # args are (x, y, z, crustval, bathyval, doSchematics)
-                x = args[0]
-                y = args[1]
-                z = args[2]
-                crustval = args[3]
-                bathyval = args[4]
-                doSchematics = args[5]
+    def load(key, doSchematics):
+        """Returns the schematic for a landcover value, loading it on first use."""
+        try:
+            return Schematic.schems[key]
+        except KeyError:
+            (name, nameoffset, layout, offset) = Schematic.definitions[key]
+            if doSchematics:
                 try:
-                    Schematic.schems[key]
-                except KeyError:
-                    if doSchematics:
-                        try:
-                            newschem = Schematic(tag=name, offset=nameoffset)
-                        except IOError:
-                            newschem = Schematic(layout=layout, offset=offset)
-                    else:
-                        newschem = Schematic(layout=layout, offset=offset)
-                    Schematic.schems[key] = newschem
-                schem = Schematic.schems[key]
-                return (y + schem.height - schem.offset, [(crustval, 'Dirt')] + schem.layout[x % schem.length][z % schem.width], None)
-            return wrapper
-        return decorator
+                    newschem = Schematic(tag=name, offset=nameoffset)
+                except IOError:
+                    newschem = Schematic(layout=layout, offset=offset)
+            else:
+                newschem = Schematic(layout=layout, offset=offset)
+            Schematic.schems[key] = newschem
+            return newschem
+
+    @staticmethod
+    def preload(doSchematics):
+        """Loads every registered schematic up front."""
+        for key in Schematic.definitions:
+            Schematic.load(key, doSchematics)
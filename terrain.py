@@ -1,5 +1,6 @@
-from random import random, choice
-from utils import materialNamed, height
+from random import Random
+import numpy as np
+from palette import Palette
 from schematic import Schematic
 
 
@@ -22,165 +23,243 @@ class Terrain(object):
 
     # schematic defaults
     # 21: 10%, 22: 35%, 23: 65%, 24: 90%, 25: 95%
-    layout21 = [[[(1, 'Stone' if random() < 0.1 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
-    layout22 = [[[(1, 'Stone' if random() < 0.35 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
-    layout23 = [[[(1, 'Stone' if random() < 0.65 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
-    layout24 = [[[(1, 'Stone' if random() < 0.90 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
-    layout25 = [[[(1, 'Stone' if random() < 0.95 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
+    # these use their own generator so every process and run agrees
+    layoutrandom = Random(0)
+    layout21 = [[[(1, 'Stone' if layoutrandom.random() < 0.1 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
+    layout22 = [[[(1, 'Stone' if layoutrandom.random() < 0.35 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
+    layout23 = [[[(1, 'Stone' if layoutrandom.random() < 0.65 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
+    layout24 = [[[(1, 'Stone' if layoutrandom.random() < 0.90 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
+    layout25 = [[[(1, 'Stone' if layoutrandom.random() < 0.95 else 'Grass')] for x in xrange(10)] for x in xrange(10)]
+
+    # rules for landcover values without schematics
+    # layers: (depth, block) from the bottom up, above the stone core
+    #   depth is a number of blocks or comes from the map:
+    #   'crust', 'bathy' or 'shore' (crust less half the water depth)
+    # raise: how far the top of the column is above the elevation
+    # patch: (probability, block) replacing the top layer, nothing grows on it
+    # trees: (probability, trees) with equal chances for each tree
+    # plants: (probability, blocks) placed on top, raising the column by one
+    desertTrees = ['Cactus', 'Cactus', 'Cactus', 'Sugar Cane']
+    # 80% Tall Grass, 10% Flower, 10% Rose
+    grassPlants = [('Tall Grass', 1)] * 8 + ['Flower', 'Rose']
+    rules = {
+        # 0: default
+        0: {'layers': [('crust', 'Obsidian')]},
+        # 11: water
+        11: {'layers': [('shore', 'Sand'), ('bathy', 'Water')]},
+        # 12: ice
+        12: {'layers': [('crust', 'Dirt'), (1, 'Snow Layer')], 'raise': 1},
+        # 31: barren land (rock/sand/clay)
+        31: {'layers': [('crust', 'Sand'), (2, 'Sand')], 'patch': (0.50, 'Stone'), 'trees': (treeProb, desertTrees)},
+        # 32: transitional
+        32: {'layers': [('crust', 'Sand'), (2, 'Sand')], 'trees': (treeProb, desertTrees)},
+        # 41: deciduous forest
+        41: {'layers': [('crust', 'Dirt'), (1, 'Grass')], 'trees': (forestProb, ['Redwood'])},
+        # 42: evergreen forest
+        42: {'layers': [('crust', 'Dirt'), (1, 'Grass')], 'trees': (forestProb, ['Birch'])},
+        # 43: mixed forest
+        43: {'layers': [('crust', 'Dirt'), (1, 'Grass')], 'trees': (forestProb, ['Redwood', 'Birch'])},
+        # 51: shrubland
+        51: {'layers': [('crust', 'Dirt'), (1, 'Grass')], 'patch': (0.25, 'Stone'), 'trees': (treeProb, ['Shrub'])},
+        # 71: grassland
+        71: {'layers': [('crust', 'Dirt'), (1, 'Grass')], 'plants': (0.75, grassPlants)},
+        # 81: pasture/hay
+        81: {'layers': [('crust', 'Dirt'), (1, 'Grass')], 'plants': (0.50, grassPlants)},
+        # 91: wetlands
+        91: {'layers': [('crust', 'Dirt'), (1, 'Grass')], 'plants': (tallgrassProb, grassPlants)}}
+
+    # depths which come from the map, in table order after constant depths
+    mapdepths = ['crust', 'shore', 'bathy']
+
+    # schematics for landcover values
+    # (name, nameoffset, layout, offset) where the named schematic file is
+    # used if schematics are enabled and the layout otherwise
+    # columns are dirt to the crust depth with the schematic on top
+    schematics = {
+        # 21: developed/open-space (<20% developed)
+        21: ('OpenSpace', 2, layout21, 0),
+        # 22: developed/low-intensity (20-49% developed)
+        22: ('Neighborhood', 2, layout22, 0),
+        # 23: developed/medium-intensity (50-79% developed)
+        23: ('School', 2, layout23, 0),
+        # 24: developed/high-intensity (80-100% developed)
+        24: ('Apartments', 2, layout24, 0),
+        # 25: commercial-industrial-transportation
+        25: ('Commercial', 2, layout25, 0),
+        # 82: crops
+        82: ('Farm', 2, [[[(1, ('Farmland', 7)), (1, ('Crops', 7))]]], 1)}
 
-    # helper methods
     @staticmethod
-    def placetree(treeProb, whichTree):
-        # two possibilities for whichTree:
-        # string: 100% this kind of tree
-        # list: equal chances on which kind of tree
-        treeType = choice(whichTree) if isinstance(whichTree, list) else whichTree
-        return treeType if random() < treeProb else None
-
-    # common Terrain methods
-    # all Terrain methods accept (x, y, z, crustval) at least
-    # all Terrain methods return (y, column, tree)
-    # y: integer level for top of the column (usually unmodified)
-    # column: list of counts and blocks with optional data
-    # tree: either a type of tree or None
-    @staticmethod
-    def placedirt(x, y, z, crustval):
-        return (y, [(crustval, 'Dirt')], None)
-
-    @staticmethod
-    def placewater(x, y, z, crustval, bathyval):
-        # NB: no longer valid for 12!
-        newcrustval = int(max(0, crustval-(bathyval/2)))
-        return (y, [(newcrustval, 'Sand'), (bathyval, 'Water')], None)
-
-    @staticmethod
-    def placeice(x, y, z, crustval):
-        return (y+1, [(crustval, 'Dirt'), (1, 'Snow Layer')], None)
-
-    @staticmethod
-    def placedesert(x, y, z, crustval, stoneProb=0):
-        choices = ['Cactus', 'Cactus', 'Cactus', 'Sugar Cane']
-        (blockType, tree) = ('Stone', None) if random() < stoneProb else ('Sand', Terrain.placetree(Terrain.treeProb, choices))
-        return (y, [(crustval, 'Sand'), (2, blockType)], tree)
+    def known(lcval):
+        """Returns True if a landcover value has a rule or a schematic."""
+        return lcval in Terrain.rules or lcval in Terrain.schematics
 
     @staticmethod
-    def placeforest(x, y, z, crustval, trees):
-        return (y, [(crustval, 'Dirt'), (1, 'Grass')], Terrain.placetree(Terrain.forestProb, trees))
+    def compile(rules, size=256):
+        """Returns the rules as NumPy tables indexed by landcover value."""
+        layers = max([len(rule['layers']) + ('plants' in rule) for rule in rules.values()])
+        trees = sorted(set([tree for rule in rules.values() if 'trees' in rule for tree in rule['trees'][1]]))
+        maxtrees = max([len(rule['trees'][1]) for rule in rules.values() if 'trees' in rule])
+        maxplants = max([len(rule['plants'][1]) for rule in rules.values() if 'plants' in rule])
+        tables = {'treenames': trees,
+                  'ruled': np.zeros(size, dtype=bool),
+                  'schematic': np.zeros(size, dtype=bool),
+                  'raise': np.zeros(size, dtype=np.int32),
+                  'depthkind': np.zeros((layers, size), dtype=np.int32),
+                  'depth': np.zeros((layers, size), dtype=np.int32),
+                  'block': np.zeros((layers, size), dtype=np.int32),
+                  'data': np.zeros((layers, size), dtype=np.int32),
+                  'patchprob': np.zeros(size),
+                  'patchslot': np.zeros(size, dtype=np.int32),
+                  'patchblock': np.zeros(size, dtype=np.int32),
+                  'patchdata': np.zeros(size, dtype=np.int32),
+                  'treeprob': np.zeros(size),
+                  'ntrees': np.zeros(size, dtype=np.int32),
+                  'trees': -np.ones((size, maxtrees), dtype=np.int32),
+                  'plantprob': np.zeros(size),
+                  'plantslot': np.zeros(size, dtype=np.int32),
+                  'nplants': np.zeros(size, dtype=np.int32),
+                  'plantblocks': np.zeros((size, maxplants), dtype=np.int32),
+                  'plantdatas': np.zeros((size, maxplants), dtype=np.int32)}
+        for lcval in Terrain.schematics:
+            tables['schematic'][lcval] = True
+            tables['depthkind'][0, lcval] = Terrain.mapdepths.index('crust') + 1
+            (tables['block'][0, lcval], tables['data'][0, lcval]) = Palette.resolve('Dirt')
+        for lcval, rule in rules.items():
+            tables['ruled'][lcval] = True
+            tables['raise'][lcval] = rule.get('raise', 0)
+            for slot, (depth, block) in enumerate(rule['layers']):
+                if depth in Terrain.mapdepths:
+                    tables['depthkind'][slot, lcval] = Terrain.mapdepths.index(depth) + 1
+                else:
+                    tables['depth'][slot, lcval] = depth
+                (tables['block'][slot, lcval], tables['data'][slot, lcval]) = Palette.resolve(block)
+            if 'patch' in rule:
+                (tables['patchprob'][lcval], block) = rule['patch']
+                tables['patchslot'][lcval] = len(rule['layers']) - 1
+                (tables['patchblock'][lcval], tables['patchdata'][lcval]) = Palette.resolve(block)
+            if 'trees' in rule:
+                (tables['treeprob'][lcval], choices) = rule['trees']
+                tables['ntrees'][lcval] = len(choices)
+                tables['trees'][lcval, :len(choices)] = [trees.index(tree) for tree in choices]
+            if 'plants' in rule:
+                (tables['plantprob'][lcval], choices) = rule['plants']
+                tables['plantslot'][lcval] = len(rule['layers'])
+                tables['nplants'][lcval] = len(choices)
+                (tables['plantblocks'][lcval, :len(choices)], tables['plantdatas'][lcval, :len(choices)]) = Palette.lookup(choices)
+        return tables
 
     @staticmethod
-    def placeshrubland(x, y, z, crustval, stoneProb):
-        (blockType, tree) = ('Stone', None) if random() < stoneProb else ('Grass', Terrain.placetree(Terrain.treeProb, 'Shrub'))
-        return (y, [(crustval, 'Dirt'), (1, blockType)], tree)
+    def evaluate(lcarray, elarray, bathyarray, crustarray, randomstate, doSchematics=False, origin=(0, 0)):
+        """
+        Applies the rules to a whole tile at once.
+
+        Returns a dict of arrays indexed like the map arrays: 'top' is
+        the top of each column, 'depths', 'blocks' and 'datas' hold
+        the layers, 'schematics' holds the landcover value of columns
+        topped by a schematic or -1 and 'trees' holds an index into
+        Terrain.tables['treenames'] or -1.  Origin is the Minecraft
+        (x, z) of the first column, schematics repeat from (0, 0).
+
+        """
+        tables = Terrain.tables
+        lcvals = lcarray.astype(np.int32)
+        lcvals[(lcvals < 0) | (lcvals >= len(tables['ruled']))] = 0
+        schematic = tables['schematic'][lcvals]
+        unknown = ~schematic & ~tables['ruled'][lcvals]
+        if unknown.any():
+            print "lcval values %s not found!" % ', '.join([str(value) for value in np.unique(lcarray[unknown])])
+            lcvals[unknown] = 0
+        shape = lcvals.shape
+
+        # every draw is made for every column so the fields do not depend on landcover
+        (patchdraw, treedraw, treechoice, plantdraw, plantchoice) = randomstate.random_sample((5,) + shape)
+        patch = patchdraw < tables['patchprob'][lcvals]
+        hastree = ~patch & (treedraw < tables['treeprob'][lcvals])
+        trees = tables['trees'][lcvals, (treechoice * tables['ntrees'][lcvals]).astype(np.int32)]
+        trees[~hastree | schematic] = -1
+        plant = ~patch & (plantdraw < tables['plantprob'][lcvals])
+
+        # layer depths come from the rule or from the map
+        crust = crustarray.astype(np.int32)
+        bathy = bathyarray.astype(np.int32)
+        sources = [crust, np.maximum(0, crust - bathy // 2), bathy]
+        layers = tables['depth'].shape[0]
+        depths = np.empty((layers,) + shape, dtype=np.int32)
+        blocks = np.empty((layers,) + shape, dtype=np.int32)
+        datas = np.empty((layers,) + shape, dtype=np.int32)
+        for slot in xrange(layers):
+            depths[slot] = tables['depth'][slot][lcvals]
+            kind = tables['depthkind'][slot][lcvals]
+            for index, source in enumerate(sources, 1):
+                depths[slot][kind == index] = source[kind == index]
+            blocks[slot] = tables['block'][slot][lcvals]
+            datas[slot] = tables['data'][slot][lcvals]
+
+        # patches replace the top layer
+        patchslot = tables['patchslot'][lcvals]
+        # plants are an extra layer on top
+        plantslot = tables['plantslot'][lcvals]
+        plantindex = (plantchoice * tables['nplants'][lcvals]).astype(np.int32)
+        for slot in xrange(layers):
+            where = patch & (patchslot == slot)
+            blocks[slot][where] = tables['patchblock'][lcvals[where]]
+            datas[slot][where] = tables['patchdata'][lcvals[where]]
+            where = plant & (plantslot == slot)
+            depths[slot][where] = 1
+            blocks[slot][where] = tables['plantblocks'][lcvals[where], plantindex[where]]
+            datas[slot][where] = tables['plantdatas'][lcvals[where], plantindex[where]]
+
+        top = elarray.astype(np.int32) + tables['raise'][lcvals] + plant
+
+        # schematics sit on the dirt layer, their blocks are stamped by fill
+        schematics = np.where(schematic, lcvals, -1)
+        for lcval in np.unique(lcvals[schematic]):
+            where = lcvals == lcval
+            schem = Schematic.load(int(lcval), doSchematics)
+            depths[1][where] = schem.height
+            blocks[1][where] = 0
+            datas[1][where] = 0
+            top[where] += schem.height - schem.offset
+        return {'origin': origin, 'doSchematics': doSchematics, 'top': top, 'depths': depths, 'blocks': blocks, 'datas': datas, 'schematics': schematics, 'trees': trees}
 
     @staticmethod
-    def placegrass(x, y, z, crustval, tallgrassProb=0.05):
-        if (random() < tallgrassProb):
-            # 80% Tall Grass, 10% Flower, 10% Rose
-            choices = [('Tall Grass', 1),  ('Tall Grass', 1),  ('Tall Grass', 1),  ('Tall Grass', 1),  ('Tall Grass', 1),  ('Tall Grass', 1),  ('Tall Grass', 1),  ('Tall Grass', 1), 'Flower', 'Rose']
-            return (y+1, [(crustval, 'Dirt'), (1, 'Grass'), (1, choice(choices))], None)
-        else:
-            return (y, [(crustval, 'Dirt'), (1, 'Grass')], None)
-
-    # valid terrain functions
-    # 0: default
-    def zero(x, y, z, crustval, bathyval, doSchematics):
-        return (y, [(crustval, 'Obsidian')], None)
-
-    # 11: water
-    def eleven(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placewater(x, y, z, crustval, bathyval)
-
-    # 12: ice
-    def twelve(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placeice(x, y, z, crustval)
-
-    # 21: developed/open-space (<20% developed)
-    #@Schematic.use(21, 'OpenSpace', 2, [[[(1, 'Stone')]]], 0)
-    @Schematic.use(21, 'OpenSpace', 2, layout21, 0)
-    def twentyone(x, y, z, crustval, bathyval, doSchematics):
-        pass
-
-    # 22: developed/low-intensity (20-49% developed)
-    @Schematic.use(22, 'Neighborhood', 2, layout22, 0)
-    def twentytwo(x, y, z, crustval, bathyval, doSchematics):
-        pass
-
-    # 23: developed/medium-intensity (50-79% developed)
-    @Schematic.use(23, 'School', 2, layout23, 0)
-    def twentythree(x, y, z, crustval, bathyval, doSchematics):
-        pass
-
-    # 24: developed/high-intensity (80-100% developed)
-    @Schematic.use(24, 'Apartments', 2, layout24, 0)
-    def twentyfour(x, y, z, crustval, bathyval, doSchematics):
-        pass
-
-    # 25: commercial-industrial-transportation
-    @Schematic.use(25, 'Commercial', 2, layout25, 0)
-    def twentyfive(x, y, z, crustval, bathyval, doSchematics):
-        pass
-
-    # 31: barren land (rock/sand/clay)
-    def thirtyone(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placedesert(x, y, z, crustval, stoneProb=0.50)
-
-    # 32: transitional
-    def thirtytwo(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placedesert(x, y, z, crustval)
-
-    # 41: deciduous forest
-    def fortyone(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placeforest(x, y, z, crustval, 'Redwood')
-
-    # 42: evergreen forest
-    def fortytwo(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placeforest(x, y, z, crustval, 'Birch')
-
-    # 43: mixed forest
-    def fortythree(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placeforest(x, y, z, crustval, ['Redwood', 'Birch'])
-
-    # 51: shrubland
-    def fiftyone(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placeshrubland(x, y, z, crustval, stoneProb=0.25)
-
-    # 71: grassland
-    def seventyone(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placegrass(x, y, z, crustval, tallgrassProb=0.75)
-
-    # 81: pasture/hay
-    def eightyone(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placegrass(x, y, z, crustval, tallgrassProb=0.50)
-
-    # 82: crops
-    @Schematic.use(82, 'Farm', 2, [[[(1, ('Farmland', 7)), (1, ('Crops', 7))]]], 1)
-    def eightytwo(x, y, z, crustval, bathyval, doSchematics):
-        pass
-
-    # 91: wetlands
-    def ninetyone(x, y, z, crustval, bathyval, doSchematics):
-        return Terrain.placegrass(x, y, z, crustval)
-
-    # dictionary used by place
-    terdict = {0: zero, 11: eleven, 12: twelve, 21: twentyone, 22: twentytwo, 23: twentythree, 24: twentyfour, 25: twentyfive, 31: thirtyone, 32: thirtytwo, 41: fortyone, 42: fortytwo, 43: fortythree, 51: fiftyone, 71: seventyone, 81: eightyone, 82: eightytwo, 91: ninetyone}
-
-    # method that actually places terrain
-    @staticmethod
-    def place(x, y, z, lcval, crustval, bathyval, doSchematics):
-        try:
-            Terrain.terdict[lcval]
-        except KeyError:
-            print "lcval value %s not found!" % lcval
-        (y, column, tree) = Terrain.terdict.get(lcval, Terrain.terdict[0])(x, y, z, crustval, bathyval, doSchematics)
-        merged = [(depth, block) if isinstance(block, tuple) else (depth, (block, 0)) for (depth, block) in column]
-        # y=0 is always bedrock
-        blocks = [(0, materialNamed('Bedrock'))]
-        datas = [(0, 0)]
-        core = [((y - height(merged)), ('End Stone', 0))] + merged
-        base = 0
-        while core:
-            (depth, (block, data)) = core.pop(0)
-            [blocks.append((y, materialNamed(block) if isinstance(block, basestring) else block)) for y in xrange(base, base+depth) if y > 0]
-            [datas.append((y, data)) for y in xrange(base, base+depth) if y > 0]
-            base += depth
-        return blocks, datas, tree
+    def fill(columns, window, height):
+        """Returns block ID and data arrays indexed [z, x, y] for a window of evaluated columns."""
+        ys = np.arange(height)
+        top = columns['top'][window][..., np.newaxis]
+        depths = columns['depths'][(slice(None),) + window][..., np.newaxis]
+        layerblocks = columns['blocks'][(slice(None),) + window][..., np.newaxis]
+        layerdatas = columns['datas'][(slice(None),) + window][..., np.newaxis]
+        # layers are stacked down from the top of the column
+        starts = top - np.cumsum(depths[::-1], axis=0)[::-1]
+        ends = starts + depths
+        # y=0 is always bedrock and the core is (end) stone
+        blocks = np.where((ys >= 1) & (ys < starts[0]), Palette.ids['End Stone'], 0)
+        datas = np.zeros(blocks.shape, dtype=np.int32)
+        for slot in xrange(depths.shape[0]):
+            layer = (ys >= 1) & (ys >= starts[slot]) & (ys < ends[slot])
+            blocks = np.where(layer, layerblocks[slot], blocks)
+            datas = np.where(layer, layerdatas[slot], datas)
+
+        # schematics repeat across the map
+        schematics = columns['schematics'][window]
+        if (schematics >= 0).any():
+            zs = np.arange(window[0].start, window[0].stop)[:, np.newaxis] + columns['origin'][1]
+            xs = np.arange(window[1].start, window[1].stop)[np.newaxis, :] + columns['origin'][0]
+            zindex = np.arange(zs.shape[0])[:, np.newaxis, np.newaxis]
+            xindex = np.arange(xs.shape[1])[np.newaxis, :, np.newaxis]
+            for lcval in np.unique(schematics[schematics >= 0]):
+                schem = Schematic.load(int(lcval), columns['doSchematics'])
+                (schemblocks, schemdatas) = schem.stamp(xs, zs)
+                offset = ys - starts[1]
+                layer = (schematics == lcval)[..., np.newaxis] & (ys >= 1) & (offset >= 0) & (offset < schem.height)
+                yindex = np.clip(offset, 0, schem.height - 1)
+                blocks = np.where(layer, schemblocks[zindex, xindex, yindex], blocks)
+                datas = np.where(layer, schemdatas[zindex, xindex, yindex], datas)
+        blocks[..., 0] = Palette.ids['Bedrock']
+        return blocks, datas
+
+
+Schematic.definitions.update(Terrain.schematics)
+Terrain.tables = Terrain.compile(Terrain.rules)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+import threading
+import unittest
+from time import sleep
+from workqueue import WorkQueue, work
+
+
+class CountingWorkQueue(WorkQueue):
+    """Counts the requests of each kind it answers."""
+
+    def __init__(self, *args, **kwargs):
+        WorkQueue.__init__(self, *args, **kwargs)
+        self.ops = dict()
+
+    def dispatch(self, message):
+        with self.lock:
+            self.ops[message.get('op')] = self.ops.get(message.get('op'), 0) + 1
+        return WorkQueue.dispatch(self, message)
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def runworkers(self, queue, function, count):
+        """Runs count worker threads against the queue and returns its results."""
+        workers = [threading.Thread(target=work, args=(queue.address, function)) for dummy in xrange(count)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        results = list(queue)
+        queue.stop()
+        for worker in workers:
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+        return results
+
+    def test_renewers_stop_with_their_task(self):
+        leasetime = 0.3
+        tasks = [('test', x, 0) for x in xrange(12)]
+        queue = CountingWorkQueue(tasks, ('localhost', 0), leasetime).start()
+        before = threading.active_count()
+
+        def function(task, lease):
+            sleep(leasetime / 2)
+            return {'tilex': task[1]}
+        results = self.runworkers(queue, function, 3)
+        self.assertEqual(sorted([result['tilex'] for result in results]), range(12))
+        # each task runs for half a lease, so renews at a third of one at most once
+        self.assertTrue(queue.ops.get('renew', 0) <= len(tasks))
+        self.assertTrue(threading.active_count() <= before)
+
+    def test_lapsed_leases_are_dispatched_again(self):
+        tasks = [('test', x, 0) for x in xrange(4)]
+        queue = WorkQueue(tasks, ('localhost', 0), 0.5).start()
+        state = {'dropped': False}
+
+        def function(task, lease):
+            if task[1] == 1 and not state['dropped']:
+                # this worker goes away while holding the lease
+                state['dropped'] = True
+                raise SystemExit
+            return {'tilex': task[1]}
+
+        def dropout(address, function):
+            try:
+                work(address, function)
+            except SystemExit:
+                pass
+        workers = [threading.Thread(target=dropout, args=(queue.address, function)) for dummy in xrange(2)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        results = list(queue)
+        queue.stop()
+        self.assertEqual(sorted([result['tilex'] for result in results]), range(4))
+        self.assertEqual(queue.summary()['expired'], 1)
+
+    def test_revoked_leases_are_refused(self):
+        accepted = []
+        queue = WorkQueue([('test', 0, 0)], ('localhost', 0), 0.1, accept=lambda task, lease: accepted.append(lease)).start()
+        first = queue.dispatch({'op': 'lease', 'worker': 'first'})
+        sleep(0.2)
+        second = queue.dispatch({'op': 'lease', 'worker': 'second'})
+        self.assertEqual(second['task'], first['task'])
+        self.assertFalse(queue.dispatch({'op': 'renew', 'lease': first['lease']})['ok'])
+        self.assertFalse(queue.dispatch({'op': 'complete', 'lease': first['lease'], 'result': {'tilex': 0}})['ok'])
+        self.assertTrue(queue.dispatch({'op': 'complete', 'lease': second['lease'], 'result': {'tilex': 0}})['ok'])
+        self.assertEqual(accepted, [second['lease']])
+        self.assertEqual([result['tilex'] for result in queue], [0])
+        queue.stop()
+
+    def test_unaccepted_results_are_discarded(self):
+        def accept(task, lease):
+            raise IOError('cannot move tile into place')
+        queue = WorkQueue([('test', 0, 0)], ('localhost', 0), 5, accept=accept).start()
+        discarded = []
+        work(queue.address, lambda task, lease: {'tilex': task[1]}, discard=lambda task, lease: discarded.append(lease))
+        self.assertRaises(RuntimeError, list, queue)
+        queue.stop()
+        self.assertEqual(len(discarded), 1)
+
+    def test_failed_tasks_are_retried(self):
+        queue = WorkQueue([('test', 0, 0)], ('localhost', 0), 5, retries=1).start()
+        state = {'failures': 0}
+
+        def function(task, lease):
+            if state['failures'] == 0:
+                state['failures'] += 1
+                return {'tilex': task[1], 'error': 'first attempt fails'}
+            return {'tilex': task[1]}
+        results = self.runworkers(queue, function, 1)
+        self.assertEqual([result['tilex'] for result in results], [0])
+        self.assertEqual(queue.summary()['failures'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
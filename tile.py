@@ -3,12 +3,19 @@
 # tile class
 
 from __future__ import division
+import ast
 import yaml
-from region import Region
+import hashlib
+import random
+from regionconfig import RegionConfig
 import os
 from itertools import product
+import numpy as np
 
-from utils import cleanmkdir, setspawnandsave
+from utils import cleanmkdir, setspawnandsave, locate
+from memoize import memoize
+from phasetimer import PhaseTimer
+from mapstore import readwindow
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly
 
@@ -21,7 +28,11 @@ from ore import Ore
 class Tile(object):
     """Tiles are the base render object.  or something."""
 
-    def __init__(self, region, tilex, tiley):
+    # modules whose contents change the blocks a tile generates,
+    # along with every local module they import
+    definitions = ['tile']
+
+    def __init__(self, region, tilex, tiley, seed=None, mapstore=None, tiledir=None):
         """Create a tile based on the region and the tile's coordinates."""
         # NB: smart people check that files have been gotten.
         # today we assume that's already been done.
@@ -29,6 +40,8 @@ class Tile(object):
         self.name = region.name
         self.size = region.tilesize
         self.mapfile = region.mapfile
+        # raw array store shared by every worker, see mapstore.py
+        self.mapstore = mapstore
         self.tilex = int(tilex)
         self.tiley = int(tiley)
         self.tiles = region.tiles
@@ -40,25 +53,112 @@ class Tile(object):
         if (self.tiley < self.tiles['ymin']) or (self.tiley >= self.tiles['ymax']):
             raise AttributeError('tiley (%d) must be between %d and %d' % (self.tiley, self.tiles['ymin'], self.tiles['ymax']))
 
-        # create the tile directory if necessary
-        self.tiledir = os.path.join(region.regiondir, 'Tiles', '%dx%d' % (self.tilex, self.tiley))
-        cleanmkdir(self.tiledir)
+        # every tile gets its own seed derived from the region seed
+        self.seed = seed
+        if seed is not None:
+            self.seed = int(hashlib.sha1('%d:%d:%d' % (seed, self.tilex, self.tiley)).hexdigest()[:8], 16)
 
-    def __call__(self):
-        """Actually build the Minecraft world that corresponds to a tile."""
+        # the tile directory is only rebuilt when the tile is
+        # leased tiles are built elsewhere and moved into place
+        self.tiledir = tiledir
+        if tiledir is None:
+            self.tiledir = os.path.join(region.regiondir, 'Tiles', '%dx%d' % (self.tilex, self.tiley))
+        self.checkpointfile = os.path.join(self.tiledir, 'Checkpoint.yaml')
 
+    def readarrays(self):
+        """Returns the landcover, elevation, bathy and crust arrays for this tile."""
         # calculate offsets
         ox = (self.tilex-self.tiles['xmin'])*self.size
         oy = (self.tiley-self.tiles['ymin'])*self.size
         sx = self.size
         sy = self.size
 
+        # views into the shared store need no decoding
+        if self.mapstore is not None:
+            return readwindow(self.mapstore, ox, oy, sx, sy)
+
         # load arrays from map file
         mapds = gdal.Open(self.mapfile, GA_ReadOnly)
-        lcarray = mapds.GetRasterBand(Region.rasters['landcover']).ReadAsArray(ox, oy, sx, sy)
-        elarray = mapds.GetRasterBand(Region.rasters['elevation']).ReadAsArray(ox, oy, sx, sy)
-        bathyarray = mapds.GetRasterBand(Region.rasters['bathy']).ReadAsArray(ox, oy, sx, sy)
-        crustarray = mapds.GetRasterBand(Region.rasters['crust']).ReadAsArray(ox, oy, sx, sy)
+        lcarray = mapds.GetRasterBand(RegionConfig.rasters['landcover']).ReadAsArray(ox, oy, sx, sy)
+        elarray = mapds.GetRasterBand(RegionConfig.rasters['elevation']).ReadAsArray(ox, oy, sx, sy)
+        bathyarray = mapds.GetRasterBand(RegionConfig.rasters['bathy']).ReadAsArray(ox, oy, sx, sy)
+        crustarray = mapds.GetRasterBand(RegionConfig.rasters['crust']).ReadAsArray(ox, oy, sx, sy)
+        return (lcarray, elarray, bathyarray, crustarray)
+
+    @staticmethod
+    def definitionfiles(topdir):
+        """Returns the sources of the definition modules and the local modules they import."""
+        found = []
+        pending = list(Tile.definitions)
+        while pending:
+            name = pending.pop(0)
+            filename = os.path.join(topdir, '%s.py' % name)
+            if name in found or not os.path.exists(filename):
+                continue
+            found.append(name)
+            stream = file(filename, 'r')
+            tree = ast.parse(stream.read(), filename)
+            stream.close()
+            for node in ast.walk(tree):
+                if isinstance(node, ast.ImportFrom) and node.module is not None:
+                    pending.append(node.module.split('.')[0])
+                elif isinstance(node, ast.Import):
+                    pending.extend([alias.name.split('.')[0] for alias in node.names])
+        return [os.path.join(topdir, '%s.py' % name) for name in sorted(found)]
+
+    @staticmethod
+    @memoize()
+    def definitionsdigest():
+        """Returns a digest of everything besides the map that shapes a tile."""
+        digest = hashlib.sha1()
+        topdir = os.path.dirname(os.path.abspath(__file__))
+        filenames = Tile.definitionfiles(topdir)
+        filenames += sorted(locate('*.schematic', os.path.join(topdir, 'schematics')))
+        for filename in filenames:
+            stream = file(filename, 'rb')
+            digest.update(stream.read())
+            stream.close()
+        return digest.hexdigest()
+
+    def fingerprint(self, arrays=None):
+        """Returns a digest of the map window, parameters, definitions and seed for this tile."""
+        if arrays is None:
+            arrays = self.readarrays()
+        digest = hashlib.sha1()
+        for array in arrays:
+            digest.update(np.ascontiguousarray(array).tostring())
+        digest.update(repr((self.size, self.tilex, self.tiley, self.doOre, self.doSchematics, self.seed)))
+        digest.update(Tile.definitionsdigest())
+        return digest.hexdigest()
+
+    def checkpoint(self):
+        """Returns the saved result if this tile was completed with a matching fingerprint."""
+        if not os.path.exists(self.checkpointfile):
+            return None
+        stream = file(self.checkpointfile)
+        checkpoint = yaml.load(stream)
+        stream.close()
+        if checkpoint.get('fingerprint') != self.fingerprint():
+            return None
+        return checkpoint['result']
+
+    def __call__(self):
+        """Actually build the Minecraft world that corresponds to a tile."""
+
+        # every phase of the build is timed
+        timer = PhaseTimer()
+
+        # start over in a clean directory
+        timer.start('setup')
+        cleanmkdir(self.tiledir)
+        if self.seed is not None:
+            random.seed(self.seed)
+
+        timer.start('read')
+        (lcarray, elarray, bathyarray, crustarray) = self.readarrays()
+        timer.start('fingerprint')
+        fingerprint = self.fingerprint((lcarray, elarray, bathyarray, crustarray))
+        timer.start('setup')
 
         # calculate Minecraft corners
         self.mcoffsetx = self.tilex * self.size
@@ -69,34 +169,53 @@ class Tile(object):
         tilebox = box.BoundingBox((self.mcoffsetx, 0, self.mcoffsetz), (self.size, self.world.Height, self.size))
         self.world.createChunksInBox(tilebox)
 
-        # do the terrain thing (no trees, ore or building)
+        # do the terrain thing (no ore or building)
         self.peak = [0, 0, 0]
-        treeobjs = dict([(tree.name, tree) for tree in treeObjs])
-        self.trees = dict([(name, list()) for name in treeobjs])
-
-        for myx, myz in product(xrange(self.size), xrange(self.size)):
+        self.trees = dict([(tree.name, list()) for tree in treeObjs])
+
+        # the spawn goes on the highest column, the first one visited x by x
+        (peakx, peakz) = np.unravel_index(np.argmax(elarray.T), elarray.T.shape)
+        if elarray[peakz, peakx] > 0:
+            self.peak = [int(self.mcoffsetx+peakx), int(elarray[peakz, peakx]), int(self.mcoffsetz+peakz)]
+
+        # landcover rules are evaluated for the whole tile at once
+        timer.start('terrain')
+        randomstate = np.random.RandomState(self.seed)
+        columns = Terrain.evaluate(lcarray, elarray, bathyarray, crustarray, randomstate, self.doSchematics, (self.mcoffsetx, self.mcoffsetz))
+
+        # and written a chunk at a time
+        timer.start('fill')
+        for chunkz, chunkx in product(xrange(self.size // 16), xrange(self.size // 16)):
+            window = (slice(chunkz*16, chunkz*16+16), slice(chunkx*16, chunkx*16+16))
+            (blocks, datas) = Terrain.fill(columns, window, self.world.Height)
+            chunk = self.world.getChunk((self.mcoffsetx >> 4) + chunkx, (self.mcoffsetz >> 4) + chunkz)
+            # chunk arrays are indexed [x, z, y]
+            chunk.Blocks[:] = blocks.swapaxes(0, 1)
+            chunk.Data[:] = datas.swapaxes(0, 1)
+            chunk.chunkChanged()
+            timer.count('blocks', np.count_nonzero(blocks))
+
+        # trees go on the terrain
+        timer.start('trees')
+        treenames = Terrain.tables['treenames']
+        for myx, myz in zip(*np.nonzero(columns['trees'].T >= 0)):
             mcx = int(self.mcoffsetx+myx)
             mcz = int(self.mcoffsetz+myz)
             mcy = int(elarray[myz, myx])
-            lcval = int(lcarray[myz, myx])
-            bathyval = int(bathyarray[myz, myx])
-            crustval = int(crustarray[myz, myx])
-            if mcy > self.peak[1]:
-                self.peak = [mcx, mcy, mcz]
-            (blocks, datas, tree) = Terrain.place(mcx, mcy, mcz, lcval, crustval, bathyval, self.doSchematics)
-            [self.world.setBlockAt(mcx, y, mcz, block) for (y, block) in blocks if block != 0]
-            [self.world.setBlockDataAt(mcx, y, mcz, data) for (y, data) in datas if data != 0]
-            # if trees are placed, elevation cannot be changed
-            if tree:
-                Tree.placetreeintile(self, tree, mcx, mcy, mcz)
+            timer.count('blocks', Tree.placetreeintile(self, treenames[columns['trees'][myz, myx]], mcx, mcy, mcz))
 
         # now that terrain and trees are done, place ore
         if self.doOre:
-            Ore.placeoreintile(self)
+            timer.start('ores')
+            timer.count('blocks', Ore.placeoreintile(self))
 
         # stick the player and the spawn at the peak
+        timer.start('save')
         setspawnandsave(self.world, self.peak)
 
+        # chunk inventory for the merge
+        self.chunks = [list(cPos) for cPos in self.world.allChunks]
+
         # write Tile.yaml with relevant data (peak at least)
         # NB: world is not dump-friendly. :-)
         del self.world
@@ -104,5 +223,16 @@ class Tile(object):
         yaml.dump(self, stream)
         stream.close()
 
-        # return peak
-        return self.peak
+        # the checkpoint is written last and marks the tile as complete
+        self.timings = timer.result()
+        result = self.result()
+        stream = file(self.checkpointfile, 'w')
+        yaml.dump({'fingerprint': fingerprint, 'result': result}, stream)
+        stream.close()
+
+        # return everything the region needs from this tile
+        return result
+
+    def result(self):
+        """Returns the data needed to merge this tile into its region."""
+        return {'tilex': self.tilex, 'tiley': self.tiley, 'peak': self.peak, 'trees': self.trees, 'ores': getattr(self, 'ores', dict()), 'chunks': self.chunks, 'timings': self.timings}
@@ -0,0 +1,74 @@
+# tile statistics module
+from __future__ import division
+import numpy as np
+import yaml
+from itertools import product
+
+
+class TileStats(object):
+    """Per-tile landcover histograms and elevation ranges used to schedule tiles."""
+
+    # relative cost of a column for each landcover value
+    # forests plant trees, developed areas and crops use schematics
+    # anything not listed costs 1.0
+    lccost = {0: 0.5, 11: 0.75, 12: 0.75, 41: 1.5, 42: 1.5, 43: 1.5}
+    schemcost = {21: 2.0, 22: 2.5, 23: 2.5, 24: 3.0, 25: 3.0, 82: 2.0}
+
+    # relative cost of each block in a column above bedrock
+    blockcost = 0.02
+
+    def __init__(self, tiles, size):
+        self.tiles = tiles
+        self.size = size
+        self.landcover = dict()
+        self.elevation = dict()
+
+    def windows(self):
+        """Yields tile coordinates and the matching map window."""
+        for tilex, tiley in product(xrange(self.tiles['xmin'], self.tiles['xmax']), xrange(self.tiles['ymin'], self.tiles['ymax'])):
+            ox = (tilex-self.tiles['xmin'])*self.size
+            oy = (tiley-self.tiles['ymin'])*self.size
+            yield tilex, tiley, (slice(oy, oy+self.size), slice(ox, ox+self.size))
+
+    @staticmethod
+    def key(tilex, tiley):
+        return '%dx%d' % (tilex, tiley)
+
+    def addlandcover(self, lcarray):
+        """Records the landcover histogram of every tile."""
+        for tilex, tiley, window in self.windows():
+            counts = np.bincount(lcarray[window].ravel().astype(np.int64))
+            self.landcover[TileStats.key(tilex, tiley)] = dict([(int(value), int(counts[value])) for value in np.nonzero(counts)[0]])
+
+    def addelevation(self, elarray):
+        """Records the minimum, mean and maximum elevation of every tile."""
+        for tilex, tiley, window in self.windows():
+            tilearr = elarray[window]
+            self.elevation[TileStats.key(tilex, tiley)] = [int(tilearr.min()), float(tilearr.mean()), int(tilearr.max())]
+
+    def cost(self, tilex, tiley, doSchematics=False):
+        """Returns the estimated relative cost of building a tile."""
+        key = TileStats.key(tilex, tiley)
+        histogram = self.landcover.get(key, {})
+        weights = dict(TileStats.lccost)
+        if doSchematics:
+            weights.update(TileStats.schemcost)
+        columns = sum([count * weights.get(value, 1.0) for value, count in histogram.items()])
+        if key in self.elevation:
+            columns *= 1 + TileStats.blockcost * self.elevation[key][1]
+        return columns
+
+    def save(self, filename):
+        stream = file(filename, 'w')
+        yaml.dump({'tiles': self.tiles, 'size': self.size, 'landcover': self.landcover, 'elevation': self.elevation}, stream)
+        stream.close()
+
+    @staticmethod
+    def load(filename):
+        stream = file(filename)
+        data = yaml.load(stream)
+        stream.close()
+        stats = TileStats(data['tiles'], data['size'])
+        stats.landcover = data['landcover']
+        stats.elevation = data['elevation']
+        return stats
@@ -4,7 +4,7 @@ from math import hypot
 import numpy
 from random import randint
 from itertools import product
-from utils import materialNamed
+from palette import Palette
 
 
 class Tree(object):
@@ -45,40 +45,62 @@ class Tree(object):
         else:
             raise AttributeError('heights array is not right: ', heights)
 
-    # call routine places a tree in a particular location
-    def __call__(self, coords):
-        """Places tree in a particular location."""
-        # coords: [x, y, z]
-        # __call__ returns blocks, datas
-        # which are lists of x, y, z, value tuples
-        (x, base, z) = coords
-        height = randint(self.heights[0], self.heights[1])
-        leafbottom = base + self.heights[2]
-        maxleafheight = base + height + 1
-        leafheight = maxleafheight - leafbottom
+        # stamps are block offsets from the base keyed by height
+        self.stamps = dict()
+
+    def stamp(self, height):
+        """Returns the block IDs and datas of a tree of the given height relative to its base."""
+        try:
+            return self.stamps[height]
+        except KeyError:
+            pass
+        leafbottom = self.heights[2]
+        leafheight = height + 1 - leafbottom
         # cactus and sugarcane have no patterns
         if self.pattern is None:
-            blocks = [(x, base+y, z, self.data) for y in xrange(height)]
+            blockID = Palette.ids[self.data]
+            blocks = [(0, y, 0, blockID) for y in xrange(height)]
             datas = []
         else:
             blocks = []
             datas = []
             lxzrange = xrange(Tree.leafDistance.shape[0])
             lyrange = xrange(leafheight)
+            leavesID = Palette.ids['Leaves']
+            woodID = Palette.ids['Wood']
             for leafx, leafz, leafy in product(lxzrange, lxzrange, lyrange):
-                myleafx = x+leafx-Tree.treeWidth
+                myleafx = leafx-Tree.treeWidth
                 myleafy = leafbottom+leafy
-                myleafz = z+leafz-Tree.treeWidth
+                myleafz = leafz-Tree.treeWidth
                 if self.pattern(leafx, leafy, leafz, leafheight-1):
-                    blocks.append((myleafx, myleafy, myleafz, 'Leaves'))
+                    blocks.append((myleafx, myleafy, myleafz, leavesID))
                     datas.append((myleafx, myleafy, myleafz, self.data))
-            for y in xrange(base, base+height):
-                blocks.append((x, y, z, 'Wood'))
-                datas.append((x, y, z, self.data))
-        return blocks, datas
+            for y in xrange(height):
+                blocks.append((0, y, 0, woodID))
+                datas.append((0, y, 0, self.data))
+        self.stamps[height] = (blocks, datas)
+        return self.stamps[height]
+
+    def compile(self):
+        """Builds the stamps for every height this tree can have."""
+        for height in xrange(self.heights[0], self.heights[1]+1):
+            self.stamp(height)
+
+    # call routine places a tree in a particular location
+    def __call__(self, coords):
+        """Places tree in a particular location."""
+        # coords: [x, y, z]
+        # __call__ returns blocks, datas
+        # which are lists of x, y, z, value tuples
+        # where block values are block IDs
+        (x, base, z) = coords
+        height = randint(self.heights[0], self.heights[1])
+        (blocks, datas) = self.stamp(height)
+        return [(x+dx, base+dy, z+dz, block) for (dx, dy, dz, block) in blocks], [(x+dx, base+dy, z+dz, data) for (dx, dy, dz, data) in datas]
 
     @staticmethod
     def placetreeintile(tile, tree, mcx, mcy, mcz):
+        """Plants a tree in a tile or defers it to the region, returns the number of blocks placed."""
         coords = [mcx, mcy, mcz]
         myx = tile.mcoffsetx - mcx
         myz = tile.mcoffsetx - mcz
@@ -89,11 +111,13 @@ class Tree(object):
             except KeyError:
                 tile.trees[tree] = []
             tile.trees[tree].append(coords)
+            return 0
         else:
             # plant it now!
             (blocks, datas) = treeObjs[tree](coords)
-            [tile.world.setBlockAt(x, y, z, materialNamed(block)) for (x, y, z, block) in blocks if block != 'Air']
+            [tile.world.setBlockAt(x, y, z, block) for (x, y, z, block) in blocks if block != 0]
             [tile.world.setBlockDataAt(x, y, z, data) for (x, y, z, data) in datas if data != 0]
+            return len([block for (x, y, z, block) in blocks if block != 0])
 
     @staticmethod
     def placetreesinregion(trees, treeobjs, world):
@@ -101,7 +125,7 @@ class Tree(object):
             coords = trees[tree]
             for coord in coords:
                 (blocks, datas) = treeobjs[tree](coord)
-                [world.setBlockAt(x, y, z, materialNamed(block)) for (x, y, z, block) in blocks if block != 'Air']
+                [world.setBlockAt(x, y, z, block) for (x, y, z, block) in blocks if block != 0]
                 [world.setBlockDataAt(x, y, z, data) for (x, y, z, data) in datas if data != 0]
 
 treeObjs = [
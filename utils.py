@@ -3,7 +3,9 @@ import os
 import fnmatch
 import shutil
 from memoize import memoize
+from worldsave import saveregions
 from pymclevel.materials import alphaMaterials
+from palette import Palette
 import numpy as np
 from math import log
 
@@ -25,21 +27,14 @@ def setspawnandsave(world, point):
     spawn = point
     spawn[1] += 2
     world.setPlayerSpawnPosition(tuple(spawn))
-    sizeOnDisk = 0
-    # NB: numchunks is calculable = (region.tilesize/chunkWidth)*(region.tilesize/chunkWidth)
-    numchunks = 0
-    for i, cPos in enumerate(world.allChunks, 1):
-        ch = world.getChunk(*cPos)
-        numchunks += 1
-        sizeOnDisk += ch.compressedSize()
-    world.SizeOnDisk = sizeOnDisk
+    # chunks are compressed once, SizeOnDisk comes from what was written
+    world.SizeOnDisk = saveregions(world)
     world.saveInPlace()
 
 
-@memoize()
 def materialNamed(string):
     "Returns block ID for block with name given in string."
-    return [v.ID for v in alphaMaterials.allBlocks if v.name == string][0]
+    return Palette.ids[string]
 
 
 @memoize()
@@ -68,13 +63,6 @@ def locate(pattern, root=os.curdir):
             yield os.path.join(path, filename)
 
 
-def chunks(data, chunksize=100):
-    """Overly-simple chunker..."""
-    intervals = range(0, data.size, chunksize) + [None]
-    for start, stop in zip(intervals[:-1], intervals[1:]):
-        yield np.array(data[start:stop])
-
-
 def build_tree(coords):
     """Build left-balanced KD tree from coordinates."""
     # initialize tree and stack
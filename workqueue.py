@@ -0,0 +1,233 @@
+# work queue module
+import json
+import socket
+import threading
+import traceback
+import SocketServer
+import Queue
+from time import time, sleep
+import numpy as np
+
+
+def plain(value):
+    """Converts NumPy values in tile results to plain JSON types."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def request(address, message, timeout=60):
+    """Sends one request to a work queue and returns its reply."""
+    conn = socket.create_connection(address, timeout)
+    try:
+        conn.sendall(json.dumps(message, default=plain) + '\n')
+        reply = conn.makefile('r').readline()
+    finally:
+        conn.close()
+    if not reply:
+        raise IOError('no reply from work queue at %s:%d' % address)
+    return json.loads(reply)
+
+
+class WorkQueueHandler(SocketServer.StreamRequestHandler):
+    """Answers one newline-delimited JSON request per connection."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        message = json.loads(line)
+        reply = self.server.workqueue.dispatch(message)
+        self.wfile.write(json.dumps(reply, default=plain) + '\n')
+
+
+class WorkQueueServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class WorkQueue(object):
+    """
+    Serves tasks to workers on any host over TCP with leases.
+
+    A worker leases a task, renews the lease while it works and
+    completes or fails it.  Tasks whose lease runs out, because the
+    worker died or lost its connection, are handed out again and the
+    old lease is revoked: its renewals and completion are refused, so
+    only completions under a live lease are accepted.  An accept
+    function, if given, is called with the task and lease of each
+    accepted completion before its result is queued.
+
+    """
+
+    def __init__(self, tasks, address=('', 0), leasetime=300, retries=0, accept=None):
+        self.pending = list(tasks)
+        self.leases = dict()
+        self.attempts = dict()
+        self.done = set()
+        self.total = len(self.pending)
+        self.leasetime = leasetime
+        self.retries = retries
+        self.accept = accept
+        self.nextlease = 0
+        self.workers = set()
+        self.expired = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.results = Queue.Queue()
+        self.server = WorkQueueServer(address, WorkQueueHandler)
+        self.server.workqueue = self
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @staticmethod
+    def key(task):
+        """Returns the hashable key of a task."""
+        return json.dumps(task)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expire(self):
+        """Returns tasks with lapsed leases to the queue."""
+        now = time()
+        for lease in [lease for lease in self.leases if self.leases[lease]['expires'] < now]:
+            task = self.leases.pop(lease)['task']
+            if WorkQueue.key(task) not in self.done:
+                print "Lease on task %s expired, dispatching again" % (task,)
+                self.expired += 1
+                self.pending.append(task)
+
+    def dispatch(self, message):
+        """Returns the reply to a worker request."""
+        with self.lock:
+            self.expire()
+            op = message.get('op')
+            self.workers.add(message.get('worker'))
+            if op == 'lease':
+                if self.pending:
+                    task = self.pending.pop(0)
+                    self.nextlease += 1
+                    lease = str(self.nextlease)
+                    self.leases[lease] = {'task': task, 'worker': message.get('worker'), 'expires': time() + self.leasetime}
+                    return {'lease': lease, 'task': task, 'leasetime': self.leasetime}
+                if len(self.done) == self.total:
+                    return {'finished': True}
+                # leased tasks may still come back
+                return {'wait': min(5, self.leasetime)}
+            lease = message.get('lease')
+            if lease not in self.leases:
+                return {'ok': False}
+            if op == 'renew':
+                self.leases[lease]['expires'] = time() + self.leasetime
+                return {'ok': True}
+            task = self.leases.pop(lease)['task']
+            key = WorkQueue.key(task)
+            if op == 'complete' and key not in self.done and self.accept is not None:
+                try:
+                    self.accept(task, lease)
+                except Exception:
+                    # a completion which cannot be accepted counts as a failure
+                    (op, message) = ('fail', dict(message, error=traceback.format_exc()))
+            if op == 'complete':
+                if key in self.done:
+                    return {'ok': False}
+                self.done.add(key)
+                self.results.put(message['result'])
+                return {'ok': True}
+            if op == 'fail':
+                self.attempts[key] = self.attempts.get(key, 0) + 1
+                self.failures += 1
+                print "Task %s failed on %s:\n%s" % (task, message.get('worker'), message.get('error'))
+                if self.attempts[key] > self.retries:
+                    self.done.add(key)
+                    self.results.put({'failed': task, 'error': message.get('error')})
+                else:
+                    self.pending.append(task)
+                return {'ok': False}
+            return {'ok': False}
+
+    def summary(self):
+        """Returns counts worth keeping in a run report."""
+        with self.lock:
+            return {'tasks': self.total, 'workers': len(self.workers - set([None])), 'expired': self.expired, 'failures': self.failures}
+
+    def __iter__(self):
+        """Yields results as workers complete tasks, raising RuntimeError if any task failed for good."""
+        failed = []
+        for count in xrange(self.total):
+            result = self.results.get()
+            if 'failed' in result:
+                failed.append(result['failed'])
+            else:
+                yield result
+        if failed:
+            raise RuntimeError('%d tasks failed, rerun to resume' % len(failed))
+
+
+def renew(address, lease, leasetime, stopped):
+    """Renews a lease every third of its time until stopped is set or the lease is revoked."""
+    while not stopped.wait(leasetime / 3.0):
+        try:
+            reply = request(address, {'op': 'renew', 'lease': lease})
+        except (IOError, socket.error):
+            continue
+        if not reply.get('ok'):
+            print "Lease %s was revoked, its result will be discarded" % lease
+            return
+
+
+def work(address, function, worker=None, discard=None):
+    """
+    Leases tasks from a work queue and runs function on each until the queue is finished.
+
+    The function is called with the task and its lease.  If the queue
+    does not accept the result, because the task failed or the lease was
+    revoked, discard is called with the same arguments to clean up.
+
+    """
+    if worker is None:
+        worker = '%s-%d' % (socket.gethostname(), threading.current_thread().ident)
+    count = 0
+    connected = False
+    while True:
+        try:
+            reply = request(address, {'op': 'lease', 'worker': worker})
+        except socket.error:
+            # the coordinator stops serving once every task is done
+            if connected:
+                return count
+            raise
+        connected = True
+        if 'finished' in reply:
+            return count
+        if 'wait' in reply:
+            sleep(reply['wait'])
+            continue
+        lease = reply['lease']
+        # the lease is renewed while the task runs
+        stopped = threading.Event()
+        renewer = threading.Thread(target=renew, args=(address, lease, reply['leasetime'], stopped))
+        renewer.daemon = True
+        renewer.start()
+        try:
+            result = function(reply['task'], lease)
+        finally:
+            stopped.set()
+            renewer.join()
+        if 'error' in result:
+            accepted = request(address, {'op': 'fail', 'lease': lease, 'worker': worker, 'error': result['error']})
+        else:
+            accepted = request(address, {'op': 'complete', 'lease': lease, 'worker': worker, 'result': result})
+        if accepted.get('ok'):
+            count += 1
+        elif discard is not None:
+            discard(reply['task'], lease)
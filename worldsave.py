@@ -0,0 +1,140 @@
+# world save module
+import os
+import zlib
+import struct
+from time import time
+from multiprocessing import current_process, cpu_count
+from multiprocessing.pool import ThreadPool
+
+# region files are made of 4KiB sectors
+# the first two hold chunk locations and timestamps
+sectorBytes = 4096
+headerSectors = 2
+# chunk payloads start with their length and compression type
+zlibVersion = 2
+
+
+def compresschunk(data):
+    """Returns the region file payload for uncompressed chunk data."""
+    compressed = zlib.compress(data)
+    return struct.pack('>IB', len(compressed) + 1, zlibVersion) + compressed
+
+
+def readregion(filename):
+    """Returns the payloads stored in a region file, keyed by chunk position within the region."""
+    payloads = dict()
+    if not os.path.exists(filename):
+        return payloads
+    stream = file(filename, 'rb')
+    data = stream.read()
+    stream.close()
+    if len(data) < headerSectors * sectorBytes:
+        return payloads
+    offsets = struct.unpack('>1024I', data[:sectorBytes])
+    for index, offset in enumerate(offsets):
+        sector = offset >> 8
+        count = offset & 0xff
+        if sector < headerSectors or count == 0:
+            continue
+        start = sector * sectorBytes
+        (length,) = struct.unpack('>I', data[start:start+4])
+        payloads[(index % 32, index // 32)] = data[start:start+4+length]
+    return payloads
+
+
+def writeregion(filename, payloads):
+    """Writes a complete region file in one pass and returns the number of payload bytes written."""
+    offsets = [0] * 1024
+    timestamps = [0] * 1024
+    sectors = []
+    nextsector = headerSectors
+    now = int(time())
+    written = 0
+    for (lx, lz) in sorted(payloads):
+        payload = payloads[(lx, lz)]
+        count = (len(payload) + sectorBytes - 1) // sectorBytes
+        if count > 255:
+            raise IOError('chunk %d, %d in %s is too large' % (lx, lz, filename))
+        index = lx + lz * 32
+        offsets[index] = (nextsector << 8) | count
+        timestamps[index] = now
+        sectors.append(payload + '\0' * (count * sectorBytes - len(payload)))
+        nextsector += count
+        written += len(payload)
+    # replace the old file in one step so open readers never see a partial file
+    tmpname = '%s.tmp' % filename
+    stream = file(tmpname, 'wb')
+    stream.write(struct.pack('>1024I', *offsets))
+    stream.write(struct.pack('>1024I', *timestamps))
+    stream.write(''.join(sectors))
+    stream.close()
+    os.rename(tmpname, filename)
+    return written
+
+
+def regionentries(world, chunks, existing):
+    """Returns (x, z, data, fresh) for the chunks of one region file."""
+    # pymclevel is not thread-safe, so this runs in the calling thread
+    # unchanged chunks keep their existing payload
+    entries = []
+    for (cx, cz) in chunks:
+        chunk = world.getChunk(cx, cz)
+        if chunk.dirty or (cx & 31, cz & 31) not in existing:
+            data = chunk.savedTagData()
+            chunk.dirty = False
+            entries.append((cx, cz, data, True))
+        else:
+            entries.append((cx, cz, existing[(cx & 31, cz & 31)], False))
+    return entries
+
+
+def compressentry(entry):
+    (cx, cz, data, fresh) = entry
+    return (cx & 31, cz & 31, compresschunk(data) if fresh else data)
+
+
+def saveregions(world, threads=None):
+    """
+    Saves every chunk of a world, compressing each one once on a
+    thread pool and writing each region file in a single batch.
+    Returns the number of chunk bytes in the region files.
+
+    Pool workers already run one per CPU, so inside them the default
+    is a single compression thread, and elsewhere one per CPU.
+
+    """
+    regions = dict()
+    for (cx, cz) in world.allChunks:
+        regions.setdefault((cx >> 5, cz >> 5), []).append((cx, cz))
+    regiondir = os.path.join(os.path.dirname(world.filename), 'region')
+    if not os.path.exists(regiondir):
+        os.makedirs(regiondir)
+    # cached region files would go stale once they are rewritten
+    world.worldFolder.closeRegions()
+
+    # chunks are serialized here and compressed by the thread pool
+    # while the next region is serialized and the previous one written
+    if threads is None:
+        threads = 1 if current_process().daemon else cpu_count()
+    pool = ThreadPool(threads)
+    sizeOnDisk = 0
+    pending = []
+    for (rx, rz) in sorted(regions):
+        filename = os.path.join(regiondir, 'r.%d.%d.mca' % (rx, rz))
+        existing = readregion(filename)
+        pending.append((filename, existing, pool.imap(compressentry, regionentries(world, regions[(rx, rz)], existing))))
+        if len(pending) > 1:
+            sizeOnDisk += writepending(pending.pop(0))
+    while pending:
+        sizeOnDisk += writepending(pending.pop(0))
+    pool.close()
+    pool.join()
+    return sizeOnDisk
+
+
+def writepending(pending):
+    (filename, existing, results) = pending
+    payloads = dict(existing)
+    for (lx, lz, payload) in results:
+        payloads[(lx, lz)] = payload
+    return writeregion(filename, payloads)